@@ -33,8 +33,13 @@
     -d hostname:port  to debug a script
     -k ide_key        a IDE key used with proxies
     -p script.py      preload and execute script before debugging
-    -m modules        comma deliminated list of modules to ignore
-                      during debug session
+    -m modules        comma deliminated list of code to ignore during
+                      the debug session, it is not traced or stepped into:
+                        module names or globs, eg. logging,django.*
+                        directories, eg. /opt/lib
+                        @stdlib, @site-packages or @venv
+                      prefix an entry with + to debug it anyway, eg.
+                      -m @site-packages,+mylib.*
     -i interactive    start debugger in interactive mode
                       if this is used in combination with a script, then
                       interactive mode will be entered when the script has
@@ -250,6 +255,13 @@ def main(argv):
             sys.stderr.write("See 'pydbgp --help'.\n")
             return 1
         
+    try:
+        dbgp.client.set_ignore_modules(ignoreModules)
+    except DBGPError, e:
+        sys.stderr.write("pydbgp: error: %s\n" % str(e))
+        sys.stderr.write("See 'pydbgp --help'.\n")
+        return 1
+
     if nodebug:
         dbgp.client.runWithoutDebug(args, interactive, host, port, idekey, logLevel)
     else:
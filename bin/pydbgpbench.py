@@ -0,0 +1,468 @@
+#!/usr/bin/env python
+"""
+    pydbgpbench [options]
+
+    Measure what the debugger costs.  Each workload is run without the
+    debugger and under each trace engine, driven by a fake IDE on a local
+    socket that sets the breakpoints (none of them is ever hit) and runs
+    to the end.
+
+    -w workloads      comma deliminated list of workloads, default all:
+                        loop        a tight loop
+                        recursion   deep and wide recursive calls
+                        exceptions  raising and catching exceptions
+                        generators  a pipeline of generators
+                        threads     a threaded socket server
+    -c configs        comma deliminated list of configurations, default all:
+                        none        no debugger
+                        pyclient    the _pyclient python trace engine
+                        cclient     the _client C module, if built (see
+                                    pydbgpparity --help)
+    -n counts         comma deliminated breakpoint counts, default
+                      0,1,100,10000
+    -s                also step over each workload
+    -x scale          multiply the size of the workloads, default 1.0
+    -r repeat         runs of each case, the best is reported, default 1
+
+    The report gives the time of each case, the trace events per second
+    the program generated (counted once with a trivial trace function),
+    and the slowdown against running without the debugger.
+"""
+
+import sys
+import os
+import getopt
+import socket
+import threading
+import time
+import urllib
+
+WORKLOADS = ['loop', 'recursion', 'exceptions', 'generators', 'threads']
+CONFIGS = ['none', 'pyclient', 'cclient']
+
+scale = 1.0
+
+def _size(n):
+    return max(1, int(n * scale))
+
+#---- workloads, run in the child process
+
+def loop():
+    total = 0
+    for i in xrange(_size(300000)):
+        total = total + i * i
+    return total
+
+def _fib(n):
+    if n < 2:
+        return n
+    return _fib(n - 1) + _fib(n - 2)
+
+def _deep(n):
+    if n:
+        return _deep(n - 1) + 1
+    return 0
+
+def recursion():
+    for i in xrange(_size(20)):
+        _deep(500)
+    return _fib(_size(18))
+
+class BenchError(Exception):
+    pass
+
+def _lookup(d, key):
+    try:
+        return d[key]
+    except KeyError:
+        return None
+
+def exceptions():
+    d = {}
+    for i in xrange(_size(40000)):
+        _lookup(d, i)
+        try:
+            raise BenchError(i)
+        except BenchError:
+            pass
+
+def _numbers(n):
+    for i in xrange(n):
+        yield i
+
+def _squares(items):
+    for i in items:
+        yield i * i
+
+def _evens(items):
+    for i in items:
+        if not i % 2:
+            yield i
+
+def generators():
+    return sum(_evens(_squares(_numbers(_size(150000)))))
+
+def _echoClient(port, count):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.connect(('127.0.0.1', port))
+    for i in xrange(count):
+        s.sendall('ping %d\n' % i)
+        data = ''
+        while not data.endswith('\n'):
+            data = data + s.recv(1024)
+    s.close()
+
+def _echoHandler(conn):
+    data = conn.recv(1024)
+    while data:
+        conn.sendall(data)
+        data = conn.recv(1024)
+    conn.close()
+
+def threads():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+    port = server.getsockname()[1]
+    clients = []
+    for i in range(4):
+        t = threading.Thread(target=_echoClient, args=(port, _size(500)))
+        t.start()
+        clients.append(t)
+    handlers = []
+    for i in range(4):
+        conn, addr = server.accept()
+        t = threading.Thread(target=_echoHandler, args=(conn,))
+        t.start()
+        handlers.append(t)
+    for t in clients + handlers:
+        t.join()
+    server.close()
+
+def _neverRun():
+    return None # bench: breakpoint line
+
+def timeWorkload(name):
+    workload = globals()[name]
+    start = time.time()
+    workload()
+    return time.time() - start
+
+def countEvents(name):
+    counter = [0]
+    def trace(frame, event, arg):
+        counter[0] = counter[0] + 1
+        return trace
+    threading.settrace(trace)
+    sys.settrace(trace)
+    try:
+        globals()[name]()
+    finally:
+        sys.settrace(None)
+        threading.settrace(None)
+    return counter[0]
+
+def runWorkload(name, count):
+    if count:
+        sys.stdout.write('BENCH %d\n' % countEvents(name))
+        return
+    elapsed = timeWorkload(name) # bench: step line
+    sys.stdout.write('BENCH %f\n' % elapsed)
+
+#---- the fake IDE
+
+def _markerLine(marker):
+    f = open(__file__.replace('.pyc', '.py'))
+    try:
+        lineno = 0
+        for line in f:
+            lineno = lineno + 1
+            if line.rstrip().endswith('# bench: ' + marker):
+                return lineno
+    finally:
+        f.close()
+    raise ValueError('no %r line in %s' % (marker, __file__))
+
+def _fileurl(path):
+    return 'file://' + urllib.pathname2url(os.path.abspath(path))
+
+class fakeIDE(threading.Thread):
+    """Accepts the debugger connections of one benchmark run.
+
+    The first connection turns on thread debugging and sets the
+    breakpoints, then every session runs to the end.  With stepLine the
+    first session stops there and steps over it.
+    """
+
+    def __init__(self, breakpoints, stepLine=None):
+        threading.Thread.__init__(self)
+        self.setDaemon(1)
+        self.breakpoints = breakpoints
+        self.stepLine = stepLine
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.port = self.listener.getsockname()[1]
+        self.error = None
+
+    def run(self):
+        first = 1
+        while 1:
+            try:
+                conn, addr = self.listener.accept()
+            except socket.error:
+                # closed by stop()
+                return
+            t = threading.Thread(target=self._session, args=(conn, first))
+            t.setDaemon(1)
+            t.start()
+            first = 0
+
+    def stop(self):
+        self.listener.close()
+
+    def _session(self, conn, first):
+        try:
+            session = _ideSession(conn)
+            session.read()
+            if first:
+                session.command('feature_set -n multiple_sessions -v 1')
+                for url, lineno in self.breakpoints:
+                    session.command('breakpoint_set -t line -f %s -n %d'
+                                    % (url, lineno))
+                if self.stepLine:
+                    url, lineno = self.stepLine
+                    session.command('breakpoint_set -t line -r 1 -f %s -n %d'
+                                    % (url, lineno))
+                    session.command('run')
+                    session.command('step_over')
+            response = session.command('run')
+            while response.find('status="break"') >= 0:
+                response = session.command('run')
+            session.command('stop')
+        except socket.error:
+            # thread sessions may just go away when the thread is done
+            pass
+        except Exception, e:
+            self.error = e
+        conn.close()
+
+class _ideSession:
+    def __init__(self, conn):
+        self.conn = conn
+        self.buffer = ''
+        self.transactionId = 0
+
+    def read(self):
+        # a packet is length NUL xml NUL
+        while self.buffer.find('\0') < 0:
+            self._recv()
+        size, rest = self.buffer.split('\0', 1)
+        size = int(size)
+        while len(rest) < size + 1:
+            self.buffer = rest
+            self._recv()
+            rest = self.buffer
+        self.buffer = rest[size + 1:]
+        return rest[:size]
+
+    def _recv(self):
+        data = self.conn.recv(65536)
+        if not data:
+            raise socket.error('connection closed by the debugger')
+        self.buffer = self.buffer + data
+
+    def command(self, cmd):
+        self.transactionId = self.transactionId + 1
+        tid = 'transaction_id="%d"' % self.transactionId
+        self.conn.sendall('%s -i %d\0' % (cmd, self.transactionId))
+        if cmd == 'stop':
+            return ''
+        while 1:
+            packet = self.read()
+            if packet.find('<response') >= 0 and packet.find(tid) >= 0:
+                return packet
+
+#---- running the cases
+
+def _bootstrap(config, port, argv):
+    # runs in the child, starts pydbgp on this script with the engine we
+    # want to measure
+    if config == 'pyclient':
+        # hide the C module from dbgp.client
+        import imp
+        find_module = imp.find_module
+        def no_client(name, path=None):
+            if name.startswith('_client'):
+                raise ImportError(name)
+            return find_module(name, path)
+        imp.find_module = no_client
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import pydbgp
+    import dbgp._pyclient
+    if config == 'cclient' and \
+       dbgp.client.clientBase is dbgp._pyclient.clientBase:
+        sys.stderr.write('pydbgpbench: the _client C module is not built\n')
+        return 1
+    return pydbgp.main(['pydbgp', '-r',
+                        '-d', '127.0.0.1:%d' % port,
+                        os.path.abspath(__file__)] + argv)
+
+def _runChild(args, env=None):
+    """Returns what the child measured, or None and why it failed."""
+    import subprocess
+    p = subprocess.Popen([sys.executable, os.path.abspath(__file__)] + args,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         env=env)
+    output, errors = p.communicate()
+    for line in output.splitlines():
+        if line.startswith('BENCH '):
+            return float(line.split()[1]), None
+    errors = errors.strip().splitlines() or ['exit status %s' % p.returncode]
+    return None, errors[0]
+
+def runCase(workload, config, count, step):
+    """Returns the time a workload took, or None and why it could not be
+    run."""
+    argv = ['--workload', workload, '--scale', str(scale)]
+    if config == 'none':
+        return _runChild(argv)
+    url = _fileurl(__file__.replace('.pyc', '.py'))
+    breakpoints = []
+    if count:
+        # one in the file the workload runs in, the others past its end so
+        # they cost what a breakpoint in the file costs
+        breakpoints.append((url, _markerLine('breakpoint line')))
+        for i in range(count - 1):
+            breakpoints.append((url, 100000 + i))
+    stepLine = None
+    if step:
+        stepLine = (url, _markerLine('step line'))
+    ide = fakeIDE(breakpoints, stepLine)
+    ide.start()
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([p for p in sys.path if p])
+    try:
+        elapsed, error = _runChild(['--bootstrap', config,
+                                    '--port', str(ide.port)] + argv, env)
+    finally:
+        ide.stop()
+    if ide.error:
+        return None, 'fake IDE: %s' % ide.error
+    return elapsed, error
+
+def report(workloads, configs, counts, step, repeat):
+    sys.stdout.write('%-11s %-10s %6s %-5s %10s %12s %9s\n' %
+                     ('workload', 'config', 'bps', 'mode', 'seconds',
+                      'events/sec', 'slowdown'))
+    for workload in workloads:
+        events = _runChild(['--workload', workload, '--scale', str(scale),
+                            '--count'])[0]
+        base = None
+        for config in configs:
+            cases = [(0, 0)]
+            if config != 'none':
+                cases = [(count, 0) for count in counts]
+                if step:
+                    cases.append((0, 1))
+            for count, stepping in cases:
+                times = []
+                for i in range(repeat):
+                    elapsed, error = runCase(workload, config, count,
+                                             stepping)
+                    if elapsed is not None:
+                        times.append(elapsed)
+                mode = stepping and 'step' or 'run'
+                if not times:
+                    sys.stdout.write('%-11s %-10s %6d %-5s %10s  %s\n' %
+                                     (workload, config, count, mode, 'n/a',
+                                      error))
+                    continue
+                elapsed = min(times)
+                if config == 'none':
+                    base = elapsed
+                rate = '-'
+                if events and elapsed:
+                    rate = '%d' % (events / elapsed)
+                slowdown = '-'
+                if base and config != 'none':
+                    slowdown = '%.1fx' % (elapsed / base)
+                sys.stdout.write('%-11s %-10s %6d %-5s %10.3f %12s %9s\n' %
+                                 (workload, config, count, mode, elapsed,
+                                  rate, slowdown))
+                sys.stdout.flush()
+
+def main(argv):
+    global scale
+    try:
+        optlist, args = getopt.getopt(argv[1:], 'hw:c:n:sx:r:',
+            ['help', 'workload=', 'bootstrap=', 'port=', 'scale=', 'count'])
+    except getopt.GetoptError, msg:
+        sys.stderr.write("pydbgpbench: error: %s\n" % str(msg))
+        sys.stderr.write("See 'pydbgpbench --help'.\n")
+        return 1
+
+    workloads = WORKLOADS
+    configs = CONFIGS
+    counts = [0, 1, 100, 10000]
+    step = 0
+    repeat = 1
+    workload = None
+    bootstrap = None
+    port = None
+    count = 0
+    try:
+        for opt, optarg in optlist:
+            if opt in ('-h', '--help'):
+                sys.stdout.write(__doc__)
+                return 0
+            elif opt == '-w':
+                workloads = optarg.split(',')
+            elif opt == '-c':
+                configs = optarg.split(',')
+            elif opt == '-n':
+                counts = [int(n) for n in optarg.split(',')]
+            elif opt == '-s':
+                step = 1
+            elif opt in ('-x', '--scale'):
+                scale = float(optarg)
+            elif opt == '-r':
+                repeat = int(optarg)
+            elif opt == '--workload':
+                workload = optarg
+            elif opt == '--bootstrap':
+                bootstrap = optarg
+            elif opt == '--port':
+                port = int(optarg)
+            elif opt == '--count':
+                count = 1
+    except ValueError, e:
+        sys.stderr.write("pydbgpbench: error: %s\n" % str(e))
+        sys.stderr.write("See 'pydbgpbench --help'.\n")
+        return 1
+
+    if bootstrap:
+        return _bootstrap(bootstrap, port,
+                          ['--workload', workload, '--scale', str(scale)])
+    if workload:
+        runWorkload(workload, count)
+        return 0
+
+    for name in workloads:
+        if name not in WORKLOADS:
+            sys.stderr.write("pydbgpbench: error: unknown workload %r\n"
+                             % name)
+            return 1
+    for name in configs:
+        if name not in CONFIGS:
+            sys.stderr.write("pydbgpbench: error: unknown configuration %r\n"
+                             % name)
+            return 1
+    if 'none' in configs:
+        # the slowdowns are against it, so run it first
+        configs = ['none'] + [c for c in configs if c != 'none']
+    report(workloads, configs, counts, step, repeat)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit( main(sys.argv) )
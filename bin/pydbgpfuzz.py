@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+"""
+    pydbgpfuzz [options]
+
+    Check the command reading of dbgp.client.dbgpSocket.
+
+    First random command lines are split with dbgpSocket._splitCommand
+    and with listcmd.line2argv, which must give the same argv (or both
+    fail).  _splitCommand skips line2argv for the data after "--" when it
+    can.
+
+    Then the commands are sent pipelined over a local socket, in random
+    sized pieces, to dbgpSocket._getIncomingDataPacket, followed by a big
+    stdin command.  Every command has to come out in order with the argv
+    line2argv gives.  The time this takes is reported.
+
+    -n lines          number of random lines, default 100000
+    -c commands       number of pipelined commands, default 20000
+    -b kbytes         size of the stdin data, default 4096
+    -s seed           seed of the random lines, default 1
+"""
+
+import sys
+import os
+import getopt
+import random
+import socket
+import threading
+import time
+
+def _get_dbgp_client_pythonlib_path():
+    """Find the DBGP Python client library in the common install
+    configuration. Returns None if it could not be found.
+    """
+    from os.path import dirname, join, abspath, exists
+    try:
+        this_dir = dirname(abspath(__file__))
+    except NameError:
+        this_dir = dirname(abspath(sys.argv[0]))
+    candidate_paths = [
+        dirname(this_dir), # Komodo source tree layout
+        join(dirname(this_dir), "pythonlib"),
+    ]
+    for candidate_path in candidate_paths:
+        landmark = join(candidate_path, "dbgp", "__init__.py")
+        if exists(landmark):
+            return candidate_path
+
+_p = _get_dbgp_client_pythonlib_path()
+if _p: sys.path.insert(0, _p)
+import dbgp.client
+import dbgp.listcmd as listcmd
+del _p
+
+# whitespace, quotes and escapes decide how a line is split, the rest is
+# the kind of thing commands and base64 data are made of
+CHARS = ['a', 'b', 'Z', '0', '-', '=', '+', '/', ' ', ' ', '\t', '\n',
+         '\r', '\x0b', '\x0c', '"', "'", '\\']
+
+def randomLine(rand):
+    parts = []
+    for i in range(rand.randint(0, 8)):
+        if rand.random() < 0.2:
+            parts.append(rand.choice([' -- ', '--', ' --', '-- ']))
+        elif rand.random() < 0.5:
+            parts.append('-%s %s ' % (rand.choice('inctT'),
+                                      rand.randint(0, 99999)))
+        else:
+            parts.append(''.join([rand.choice(CHARS)
+                                  for j in range(rand.randint(0, 12))]))
+    return ''.join(parts)
+
+def _argv(split, line):
+    try:
+        return split(line)
+    except ValueError, e:
+        return 'ValueError: %s' % e
+
+def checkSplit(rand, count):
+    """Returns how many of count random lines split differently."""
+    split = dbgp.client.dbgpSocket.__dict__['_splitCommand']
+    failed = 0
+    for i in range(count):
+        line = randomLine(rand)
+        expected = _argv(listcmd.line2argv, line)
+        argv = _argv(lambda line: split(None, line), line)
+        if argv != expected:
+            failed = failed + 1
+            if failed <= 5:
+                sys.stdout.write('    %r\n      line2argv:     %r\n'
+                                 '      _splitCommand: %r\n'
+                                 % (line, expected, argv))
+    return failed
+
+class _mainThread:
+    # stands in for the backend the socket hands commands to
+    class dbg:
+        interrupt = 0
+
+    def __init__(self, received):
+        self.received = received
+
+    def onecmd(self, argv, prefix):
+        self.received.append(argv)
+
+class _queue:
+    def __init__(self, received):
+        self.received = received
+
+    def put(self, argv):
+        if argv is not None:
+            self.received.append(argv)
+
+def checkReceive(rand, count, stdinSize):
+    """Returns how many commands were not received as sent, and how long
+    reading them took."""
+    commands = []
+    while len(commands) < count:
+        line = randomLine(rand).replace('\0', '')
+        if type(_argv(listcmd.line2argv, line)) == type([]):
+            commands.append(line)
+    data = ''.join([rand.choice('abcdefgh0123456789+/')
+                    for i in range(1024)]) * stdinSize
+    commands.append('stdin -i 1 -- ' + data)
+    expected = [argv for argv in map(listcmd.line2argv, commands) if argv]
+    payload = '\0'.join(commands) + '\0'
+
+    received = []
+    sock = dbgp.client.dbgpSocket(_mainThread(received))
+    # it put itself in front of stdin, for the debugged program
+    sys.stdin = dbgp.client.dbgpSocket.orig_stdin
+    sock.queue = _queue(received)
+    sock._stop = 0
+    ours, sock._socket = socket.socketpair()
+
+    def feed():
+        pos = 0
+        while pos < len(payload):
+            size = rand.choice([1, 7, 100, 5000, 100000])
+            ours.sendall(payload[pos:pos+size])
+            pos = pos + size
+        ours.close()
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+    start = time.time()
+    sock._getIncomingDataPacket()
+    elapsed = time.time() - start
+    feeder.join()
+    sock._socket.close()
+
+    failed = abs(len(received) - len(expected))
+    for i in range(min(len(received), len(expected))):
+        if received[i] != expected[i]:
+            failed = failed + 1
+            if failed <= 5:
+                sys.stdout.write('    command %d: %r\n      received: %r\n'
+                                 % (i, expected[i][:8], received[i][:8]))
+    return failed, elapsed
+
+def main(argv):
+    try:
+        optlist, args = getopt.getopt(argv[1:], 'hn:c:b:s:', ['help'])
+    except getopt.GetoptError, msg:
+        sys.stderr.write("pydbgpfuzz: error: %s\n" % str(msg))
+        sys.stderr.write("See 'pydbgpfuzz --help'.\n")
+        return 1
+
+    lines = 100000
+    commands = 20000
+    stdinSize = 4096
+    seed = 1
+    try:
+        for opt, optarg in optlist:
+            if opt in ('-h', '--help'):
+                sys.stdout.write(__doc__)
+                return 0
+            elif opt == '-n':
+                lines = int(optarg)
+            elif opt == '-c':
+                commands = int(optarg)
+            elif opt == '-b':
+                stdinSize = int(optarg)
+            elif opt == '-s':
+                seed = int(optarg)
+    except ValueError, e:
+        sys.stderr.write("pydbgpfuzz: error: %s\n" % str(e))
+        sys.stderr.write("See 'pydbgpfuzz --help'.\n")
+        return 1
+
+    rand = random.Random(seed)
+    failed = checkSplit(rand, lines)
+    sys.stdout.write('split: %d of %d lines differ\n' % (failed, lines))
+    sys.stdout.flush()
+    failedReceive, elapsed = checkReceive(rand, commands, stdinSize)
+    sys.stdout.write('receive: %d of %d commands differ, read in %.2fs\n'
+                     % (failedReceive, commands + 1, elapsed))
+    return (failed or failedReceive) and 1 or 0
+
+if __name__ == "__main__":
+    sys.exit( main(sys.argv) )
@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+"""
+    pydbgpparity [options]
+
+    Check that the _client C module stops where the _pyclient python
+    trace engine does.  The C module matches line breakpoints itself
+    (hit conditions, temporary breakpoints), so the two have to be kept
+    in step by hand.
+
+    Each case is a set of line, conditional and watch breakpoints, with
+    random hit values, hit conditions, temporary and disabled flags.  A
+    fake IDE on a local socket sets them and runs a small program to the
+    end under each engine, recording every stop: the line, the loop
+    counter and the breakpoints that are left.  The two records must be
+    the same.
+
+    -n cases          number of random cases, default 200
+    -s seed           seed of the random cases, default 1
+    -v                print the breakpoints of every case
+
+    The _client C module has to be built into the dbgp package as
+    _clientXY.so for Python X.Y, which dbgp.client looks for.  The module
+    name is given with CLIENT_MODULE, for Python 2.7 on Linux:
+
+        gcc -shared -fPIC -DCLIENT_MODULE=_client27 \\
+            -I/usr/include/python2.7 dbgp/_client.c -o dbgp/_client27.so
+"""
+
+import sys
+import os
+import getopt
+import random
+import re
+import socket
+import threading
+import time
+import urllib
+
+#---- the program, run in the child process
+
+def _step(i, items):
+    total = i * 2 # parity: a
+    items.append(total) # parity: b
+    if i % 3 == 0:
+        total = total + 1 # parity: c
+    return total # parity: d
+
+def program():
+    items = []
+    total = 0
+    for i in range(30):
+        total = total + _step(i, items) # parity: e
+    return total
+
+MARKERS = ['a', 'b', 'c', 'd', 'e']
+
+# a name that is not defined tests conditions that fail to evaluate
+CONDITIONS = ['i % 4 == 1', 'i > 20', 'total > 30', 'not items',
+              'undefined_name']
+WATCHES = ['total', 'i', 'items', 'len(items)', '(i, total)', 'items[:]',
+           'undefined_name']
+HIT_CONDITIONS = ['>=', '==', '%']
+
+#---- the fake IDE
+
+def _markerLine(marker):
+    f = open(__file__.replace('.pyc', '.py'))
+    try:
+        lineno = 0
+        for line in f:
+            lineno = lineno + 1
+            if line.rstrip().endswith('# parity: ' + marker):
+                return lineno
+    finally:
+        f.close()
+    raise ValueError('no %r line in %s' % (marker, __file__))
+
+def _fileurl(path):
+    return 'file://' + urllib.pathname2url(os.path.abspath(path))
+
+def randomBreakpoints(rand):
+    """Returns the breakpoint_set commands of a random case."""
+    url = _fileurl(__file__.replace('.pyc', '.py'))
+    commands = []
+    for i in range(rand.randint(1, 5)):
+        type = rand.choice(['line', 'line', 'conditional', 'watch'])
+        args = ['-t', type, '-f', url]
+        if type != 'watch' or rand.random() < 0.5:
+            args = args + ['-n', str(_markerLine(rand.choice(MARKERS)))]
+        if rand.random() < 0.5:
+            args = args + ['-h', str(rand.randint(1, 6))]
+            if rand.random() < 0.7:
+                args = args + ['-o', rand.choice(HIT_CONDITIONS)]
+        if rand.random() < 0.3:
+            args = args + ['-r', '1']
+        if rand.random() < 0.15:
+            args = args + ['-s', 'disabled']
+        if type == 'conditional':
+            args = args + ['--', rand.choice(CONDITIONS).encode('base64')]
+        elif type == 'watch':
+            args = args + ['--', rand.choice(WATCHES).encode('base64')]
+        commands.append('breakpoint_set ' + ' '.join(args).replace('\n', ''))
+    return commands
+
+class fakeIDE(threading.Thread):
+    """Accepts the debugger connection of one run, sets the breakpoints
+    and runs to the end, recording the stops in self.stops."""
+
+    maxStops = 500
+
+    def __init__(self, breakpoints):
+        threading.Thread.__init__(self)
+        self.setDaemon(1)
+        self.breakpoints = breakpoints
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+        self.stops = []
+        self.error = None
+
+    def run(self):
+        try:
+            conn, addr = self.listener.accept()
+        except socket.error:
+            # closed by stop()
+            return
+        try:
+            try:
+                self._session(_ideSession(conn))
+            except Exception, e:
+                self.error = e
+        finally:
+            conn.close()
+
+    def stop(self):
+        self.listener.close()
+
+    def _session(self, session):
+        session.read()
+        for cmd in self.breakpoints:
+            response = session.command(cmd)
+            if response.find('<error') >= 0:
+                raise ValueError('%s: %s' % (cmd, response))
+        response = session.command('run')
+        while response.find('status="break"') >= 0:
+            if len(self.stops) >= self.maxStops:
+                raise ValueError('more than %d stops' % self.maxStops)
+            self.stops.append(self._where(session))
+            response = session.command('run')
+        try:
+            session.command('stop')
+        except socket.error:
+            # the program has ended, the debugger may be gone already
+            pass
+
+    def _where(self, session):
+        stack = session.command('stack_get -d 0')
+        lineno = re.search(r'lineno="(\d+)"', stack).group(1)
+        # i is not defined everywhere
+        response = session.command('property_get -d 0 -n i')
+        value = None
+        if response.find('<error') < 0:
+            match = re.search(r'<value( encoding="base64")?>'
+                              r'<!\[CDATA\[(.*?)\]\]>', response, re.S)
+            value = match.group(2)
+            if match.group(1):
+                value = value.decode('base64')
+        bps = session.command('breakpoint_list')
+        ids = re.findall(r'<breakpoint id="(\d+)"', bps)
+        return (int(lineno), value, tuple(ids))
+
+class _ideSession:
+    def __init__(self, conn):
+        self.conn = conn
+        self.buffer = ''
+        self.transactionId = 0
+
+    def read(self):
+        # a packet is length NUL xml NUL
+        while self.buffer.find('\0') < 0:
+            self._recv()
+        size, rest = self.buffer.split('\0', 1)
+        size = int(size)
+        while len(rest) < size + 1:
+            self.buffer = rest
+            self._recv()
+            rest = self.buffer
+        self.buffer = rest[size + 1:]
+        return rest[:size]
+
+    def _recv(self):
+        data = self.conn.recv(65536)
+        if not data:
+            raise socket.error('connection closed by the debugger')
+        self.buffer = self.buffer + data
+
+    def command(self, cmd):
+        self.transactionId = self.transactionId + 1
+        tid = 'transaction_id="%d"' % self.transactionId
+        # the data of a command comes after --, the options before it
+        args, sep, data = cmd.partition(' -- ')
+        self.conn.sendall('%s -i %d%s%s\0' % (args, self.transactionId,
+                                               sep, data))
+        while 1:
+            packet = self.read()
+            if packet.find('<response') >= 0 and packet.find(tid) >= 0:
+                return packet
+
+#---- running the cases
+
+def _bootstrap(config, port):
+    # runs in the child, starts pydbgp on this script with the engine we
+    # want to check
+    if config == 'pyclient':
+        # hide the C module from dbgp.client
+        import imp
+        find_module = imp.find_module
+        def no_client(name, path=None):
+            if name.startswith('_client'):
+                raise ImportError(name)
+            return find_module(name, path)
+        imp.find_module = no_client
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import pydbgp
+    import dbgp._pyclient
+    if config == 'cclient' and \
+       dbgp.client.clientBase is dbgp._pyclient.clientBase:
+        sys.stderr.write('pydbgpparity: the _client C module is not built\n')
+        return 1
+    return pydbgp.main(['pydbgp', '-r', '-d', '127.0.0.1:%d' % port,
+                        os.path.abspath(__file__), '--program'])
+
+def runCase(config, breakpoints, timeout=60):
+    """Returns the stops of a run, or None and why it failed."""
+    import subprocess
+    ide = fakeIDE(breakpoints)
+    ide.start()
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([p for p in sys.path if p])
+    try:
+        p = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                              '--bootstrap', config, '--port', str(ide.port)],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             env=env)
+        deadline = time.time() + timeout
+        while ide.isAlive() and p.poll() is None and time.time() < deadline:
+            ide.join(0.1)
+        if p.poll() is None and (ide.isAlive() or ide.error):
+            # the debugger won't end on its own then
+            p.kill()
+        output, errors = p.communicate()
+    finally:
+        ide.stop()
+    if ide.error:
+        return None, 'fake IDE: %s' % ide.error
+    if p.returncode:
+        errors = errors.strip().splitlines() or \
+                 ['exit status %s' % p.returncode]
+        return None, errors[-1]
+    if ide.isAlive():
+        return None, 'no answer from the debugger in %d seconds' % timeout
+    return ide.stops, None
+
+def check(count, seed, verbose):
+    rand = random.Random(seed)
+    failed = 0
+    for case in range(count):
+        breakpoints = randomBreakpoints(rand)
+        if verbose:
+            sys.stdout.write('case %d:\n' % case)
+            for cmd in breakpoints:
+                sys.stdout.write('    %s\n' % cmd)
+        expected, error = runCase('pyclient', breakpoints)
+        if error:
+            sys.stdout.write('case %d: pyclient failed: %s\n' % (case, error))
+            return 1
+        stops, error = runCase('cclient', breakpoints)
+        if error:
+            sys.stdout.write('case %d: cclient failed: %s\n' % (case, error))
+            return 1
+        if stops == expected:
+            if verbose:
+                sys.stdout.write('    same, %d stops\n' % len(stops))
+            continue
+        failed = failed + 1
+        sys.stdout.write('case %d: the engines differ\n' % case)
+        for cmd in breakpoints:
+            sys.stdout.write('    %s\n' % cmd)
+        for i in range(max(len(stops), len(expected))):
+            if i >= len(stops) or i >= len(expected) or \
+               stops[i] != expected[i]:
+                sys.stdout.write('    stop %d: pyclient %r, cclient %r\n'
+                                 % (i, expected[i:i+1], stops[i:i+1]))
+                break
+        sys.stdout.flush()
+    sys.stdout.write('%d of %d cases differ\n' % (failed, count))
+    return failed and 1 or 0
+
+def main(argv):
+    try:
+        optlist, args = getopt.getopt(argv[1:], 'hn:s:v',
+            ['help', 'bootstrap=', 'port=', 'program'])
+    except getopt.GetoptError, msg:
+        sys.stderr.write("pydbgpparity: error: %s\n" % str(msg))
+        sys.stderr.write("See 'pydbgpparity --help'.\n")
+        return 1
+
+    count = 200
+    seed = 1
+    verbose = 0
+    bootstrap = None
+    port = None
+    try:
+        for opt, optarg in optlist:
+            if opt in ('-h', '--help'):
+                sys.stdout.write(__doc__)
+                return 0
+            elif opt == '-n':
+                count = int(optarg)
+            elif opt == '-s':
+                seed = int(optarg)
+            elif opt == '-v':
+                verbose = 1
+            elif opt == '--bootstrap':
+                bootstrap = optarg
+            elif opt == '--port':
+                port = int(optarg)
+            elif opt == '--program':
+                program()
+                return 0
+    except ValueError, e:
+        sys.stderr.write("pydbgpparity: error: %s\n" % str(e))
+        sys.stderr.write("See 'pydbgpparity --help'.\n")
+        return 1
+
+    if bootstrap:
+        return _bootstrap(bootstrap, port)
+    return check(count, seed, verbose)
+
+if __name__ == "__main__":
+    sys.exit( main(sys.argv) )
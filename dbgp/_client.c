@@ -31,18 +31,40 @@
 #   endif
 #endif
 
+/* dbgp.client imports this module as _clientXY for Python X.Y, so the
+ * name has to be given when building it, eg. -DCLIENT_MODULE=_client27
+ */
+#ifndef CLIENT_MODULE
+#define CLIENT_MODULE _client
+#endif
+#define _ADB_STR(name)  #name
+#define ADB_STR(name)   _ADB_STR(name)
+#define _ADB_INIT(name) init##name
+#define ADB_INIT(name)  _ADB_INIT(name)
+
 
 //#define DEBUG_PRINT 1
 
 #define BOTFRAME_STEP        0x00
 #define BOTFRAME_CONTINUE    0x01
 
+// skipCache is emptied when it gets this big, see dbgp._pyclient
+#define SKIP_CACHE_SIZE      10000
+
 static PyObject *__adb_ignoreModules = NULL;
 static PyObject *__adb_debugAll = NULL;
+static long __adb_hideChildren = 0;
 static PyObject *__adb_canonicCache = NULL;
+static PyObject *__adb_skipCache = NULL;
 static PyObject *__adb_breakpointFileList = NULL;
 static PyObject *__adb_breakpointList = NULL;
+static PyObject *__adb_breakpointsByFunction = NULL;
+static PyObject *__adb_breakpointsByException = NULL;
 static PyObject *__dbgpClientModule = NULL;
+// dbgp.client._candidateCache, and the (file, line, '') key we look up
+// line breakpoints with, reused rather than built on every line
+static PyObject *__adb_candidateCache = NULL;
+static PyObject *__adb_candidateKey = NULL;
 static PyObject *PyExc_DBGPQuit;
 
 typedef struct {
@@ -50,13 +72,36 @@ typedef struct {
     PyObject *botframe;
     PyObject *stopframe;
     PyObject *returnframe;
+    /* the frame of the last exception event and its arg, until we know
+     * whether that frame handled it */
+    PyObject *exceptionFrame;
+    PyObject *exceptionInfo;
     
     long breakOnFirstCall;
     long interrupt;
     long quitting;
     long botframeBehaviour;
+
+    /* stack depths used by stop_here, -1 when we don't know them */
+    long stackDepth;
+    long frameDepth;
+    long stopframeDepth;
+    long botframeDepth;
 } AdbObject;
 
+#define _adbobj_is_stepping(self) \
+    ((self)->stopframe != Py_None || (self)->botframeBehaviour == BOTFRAME_STEP)
+
+static long _adb_frame_depth(PyFrameObject *frame)
+{
+    long depth = 0;
+    while (frame != NULL) {
+        depth++;
+        frame = frame->f_back;
+    }
+    return depth;
+}
+
 
 static long _adbobj_stop_here(AdbObject *self, PyFrameObject *frame)
 {
@@ -71,6 +116,30 @@ static long _adbobj_stop_here(AdbObject *self, PyFrameObject *frame)
         return 1;
     }
 
+    if (!_adbobj_is_stepping(self)) {
+        return 0;
+    }
+
+    // stopframe and botframe are the frames at their depth on our
+    // stack, the nearer one is where walking up the stack would end
+    if (self->frameDepth > 0) {
+        long depth = self->frameDepth;
+        long stopDepth = self->stopframeDepth;
+        long botDepth = self->botframeDepth;
+        if (botDepth < 0 && self->botframe != Py_None) {
+            botDepth = self->botframeDepth =
+                _adb_frame_depth((PyFrameObject *)self->botframe);
+        }
+        if (self->stopframe != Py_None && stopDepth > 0 && stopDepth < depth &&
+            !(stopDepth < botDepth && botDepth <= depth)) {
+            return 0;
+        }
+        if (self->botframe != Py_None && botDepth > 0 && botDepth <= depth) {
+            return self->botframeBehaviour == BOTFRAME_STEP;
+        }
+        return 0;
+    }
+
     // while frame is not None and frame is not self.stopframe:
     while (frame != NULL && (PyObject *)frame != Py_None && (PyObject *)frame != self->stopframe) {
         
@@ -90,10 +159,9 @@ static long _adbobj_stop_here(AdbObject *self, PyFrameObject *frame)
 
 static long _adbobj_trace_skip(AdbObject *self, PyFrameObject *frame)
 {
-    unsigned long ignoreSize;
-    int result;
-    unsigned int i;
-    PyObject *__obj;
+    PyObject *cached;
+    PyObject *result;
+    long skip;
 
 #ifdef DEBUG_PRINT
     fprintf(stderr, "_adbobj_trace_skip...\n");
@@ -104,67 +172,53 @@ static long _adbobj_trace_skip(AdbObject *self, PyFrameObject *frame)
         return 0;
     }
 
+    // the debugger is running code of its own, see setHideChildren
+    if (__adb_hideChildren) {
+        return 1;
+    }
+
     // if no frame or line number we skip the frame
     if (frame == NULL || frame->f_lineno == 0) {
         return 1;
     }
 
-    // if this frame is explicitly hidden, skip it
-    if (PyDict_GetItemString(frame->f_globals,"DBGPHide") != NULL) {
-        return 1;
+    // whether a module is hidden or ignored doesn't change, so remember
+    // it for each code object, see clientBase.trace_skip
+    cached = PyDict_GetItem(__adb_skipCache, (PyObject *)frame->f_code);
+    if (cached != NULL && PyTuple_GET_ITEM(cached, 0) == frame->f_globals) {
+        return PyInt_AsLong(PyTuple_GET_ITEM(cached, 1));
     }
+
+    // if this frame is explicitly hidden, skip it
+    skip = PyDict_GetItemString(frame->f_globals,"DBGPHide") != NULL;
     
-    // if the module this frame is in is in our ignore list, the skip it
-    /*
-      if self._ignoreModules and \
-        frame.f_globals.has_key('__name__') and \
-        frame.f_globals['__name__'] in self._ignoreModules:
-        return 1;
-    */
-    ignoreSize = PyList_Size(__adb_ignoreModules);
-    if (ignoreSize > 0) {
-        __obj = PyDict_GetItemString(frame->f_globals,"__name__");
-        if (__obj != NULL) {
-            for (i=0; i < ignoreSize; i++) {
-                PyObject *item = PyList_GetItem(__adb_ignoreModules, i);
-                if (item != NULL && PyString_Check(item) &&
-                    PyObject_Cmp(__obj, item, &result) != -1 &&
-                    result == 0) {
-                        return 1;
-                }
-            }
+    // if the module this frame is in is excluded by our ignore list, then
+    // skip it, see dbgp.client.set_ignore_modules
+    if (!skip && PyList_Size(__adb_ignoreModules) > 0) {
+        result = PyObject_CallMethod(__dbgpClientModule, "moduleIgnored",
+                                     "OO", frame->f_globals,
+                                     (PyObject *)frame->f_code);
+        if (result == NULL) {
+            PyErr_Clear();
+        } else {
+            skip = PyObject_IsTrue(result) == 1;
+            Py_DECREF(result);
         }
     }
 
-    /*
-        if frame and frame.f_back and frame.f_back.f_globals.has_key('DBGPHideChildren'):
-            frame.f_globals['DBGPHideChildren'] = frame.f_back.f_globals['DBGPHideChildren']
-    */
-    if (frame->f_back) {
-        __obj = PyDict_GetItemString(frame->f_back->f_globals,"DBGPHideChildren");
-        if (__obj != NULL && PyInt_Check(__obj)) {
-            PyDict_SetItemString(frame->f_globals,"DBGPHideChildren", __obj);
-            return PyInt_AsLong(__obj);
-        }
+    if (PyDict_Size(__adb_skipCache) >= SKIP_CACHE_SIZE) {
+        PyDict_Clear(__adb_skipCache);
     }
-    
-    // now we have to look through the frame stack, and see if this is
-    // a frame we need to ignore, because it is a child of a frame that .
-    // we want to bypass (eg. stdout redirection in the dbgp module).
-    // this is a bit of a perf hit, but that is prevented somewhat by the
-    // block above.  see _pyclient.py trace_skip for some comments or refer
-    // to bugs 35933 and 44620
-    while (frame != NULL) {
-        __obj = PyDict_GetItemString(frame->f_globals,"DBGPHideChildren");
-        if (__obj != NULL && PyInt_Check(__obj) && PyInt_AsLong(__obj) != 0) {
-            return PyInt_AsLong(__obj);
-        }
-        frame = frame->f_back;
+    cached = Py_BuildValue("(Ol)", frame->f_globals, skip);
+    if (cached != NULL) {
+        PyDict_SetItem(__adb_skipCache, (PyObject *)frame->f_code, cached);
+        Py_DECREF(cached);
     }
-    return 0;
+    return skip;
 }
 
-static long _adbobj_have_possible_break(AdbObject *self, PyFrameObject *frame)
+static long _adbobj_have_possible_break(AdbObject *self, PyFrameObject *frame,
+                                        char *type)
 {
     PyObject *filename;
     PyObject *tuple;
@@ -173,6 +227,20 @@ static long _adbobj_have_possible_break(AdbObject *self, PyFrameObject *frame)
 #ifdef DEBUG_PRINT
     fprintf(stderr, "_adbobj_have_possible_break...\n");
 #endif
+    // call and return breakpoints on a named function are only kept
+    // by function name, see Breakpoint.isFunctionBreakpoint
+    if ((strcmp(type, "call") == 0 || strcmp(type, "return") == 0) &&
+        PyDict_GetItem(__adb_breakpointsByFunction,
+                       frame->f_code->co_name) != NULL) {
+        return 1;
+    }
+    // likewise exception breakpoints on a named exception, effective
+    // looks at the exception class
+    if ((strcmp(type, "exception") == 0 || strcmp(type, "unwind") == 0) &&
+        PyDict_Size(__adb_breakpointsByException) > 0) {
+        return 1;
+    }
+
     if (PyDict_Size(__adb_breakpointList) < 1) {
         // no breakpoints, no possible break
         return 0;
@@ -207,19 +275,173 @@ static long _adbobj_have_possible_break(AdbObject *self, PyFrameObject *frame)
     return PyMapping_HasKeyString(__adb_breakpointFileList, "");
 }
 
+static long _adb_long_attr(PyObject *ob, char *name)
+{
+    PyObject *value = PyObject_GetAttrString(ob, name);
+    long result;
+
+    if (value == NULL) {
+        PyErr_Clear();
+        return 0;
+    }
+    result = PyInt_AsLong(value);
+    Py_DECREF(value);
+    if (result == -1 && PyErr_Occurred()) {
+        PyErr_Clear();
+        return 0;
+    }
+    return result;
+}
+
+// dbgp.client.effective for a line event in a file with breakpoints.
+// Only conditions are checked in python, hit counts, hit conditions and
+// temporary breakpoints are handled here.
+static long _adbobj_effective_line(AdbObject *self, PyFrameObject *frame,
+                                   PyObject *filename)
+{
+    PyObject *line;
+    PyObject *possibles;
+    PyObject *b;
+    PyObject *r;
+    Py_ssize_t i;
+    long hits, hitValue, hit;
+    long result = 0;
+
+    line = PyInt_FromLong(frame->f_lineno);
+    if (line == NULL) {
+        PyErr_Clear();
+        return 0;
+    }
+    Py_INCREF(filename);
+    Py_DECREF(PyTuple_GET_ITEM(__adb_candidateKey, 0));
+    PyTuple_SET_ITEM(__adb_candidateKey, 0, filename);
+    Py_DECREF(PyTuple_GET_ITEM(__adb_candidateKey, 1));
+    PyTuple_SET_ITEM(__adb_candidateKey, 1, line);
+
+    possibles = PyDict_GetItem(__adb_candidateCache, __adb_candidateKey);
+    if (possibles != NULL) {
+        Py_INCREF(possibles);
+    } else {
+        possibles = PyObject_CallMethod(__dbgpClientModule, "candidates",
+                                        "OOs", filename, line, "");
+        if (possibles == NULL) {
+            PyErr_Clear();
+            return 0;
+        }
+    }
+    if (!PyTuple_Check(possibles)) {
+        Py_DECREF(possibles);
+        return 0;
+    }
+
+    for (i = 0; i < PyTuple_GET_SIZE(possibles); i++) {
+        b = PyTuple_GET_ITEM(possibles, i);
+        r = PyObject_GetAttrString(b, "cond");
+        if (r == NULL) {
+            PyErr_Clear();
+            continue;
+        }
+        hit = PyObject_IsTrue(r);
+        Py_DECREF(r);
+        if (hit == 1) {
+            r = PyObject_CallMethod(__dbgpClientModule, "breakpointCondition",
+                                    "OOOs", b, (PyObject *)frame, Py_None, "");
+            if (r == NULL) {
+                PyErr_Clear();
+                continue;
+            }
+            hit = PyInt_AsLong(r);
+            Py_DECREF(r);
+            if (hit < 0) {
+                // the condition failed, stop but don't delete temporary
+                result = 1;
+                break;
+            }
+            if (hit == 0) {
+                continue;
+            }
+        }
+
+        // Count every hit when bp is enabled
+        hits = _adb_long_attr(b, "hits") + 1;
+        r = PyInt_FromLong(hits);
+        if (r != NULL) {
+            PyObject_SetAttrString(b, "hits", r);
+            Py_DECREF(r);
+        }
+
+        // handle hitValue/hitConditions
+        hitValue = _adb_long_attr(b, "hitValue");
+        if (hitValue) {
+            char *cond = NULL;
+            r = PyObject_GetAttrString(b, "hitCondition");
+            if (r != NULL && PyString_Check(r)) {
+                cond = PyString_AS_STRING(r);
+            }
+            hit = 1;
+            if (cond == NULL) {
+                // invalid hitCondition, ignore it
+            } else if (strcmp(cond, ">=") == 0) {
+                hit = hits >= hitValue;
+            } else if (strcmp(cond, "==") == 0) {
+                hit = hits == hitValue;
+            } else if (strcmp(cond, "%") == 0) {
+                hit = hits % hitValue == 0;
+            }
+            if (r != NULL) {
+                Py_DECREF(r);
+            } else {
+                PyErr_Clear();
+            }
+            if (!hit) {
+                continue;
+            }
+        }
+
+        // the breakpoint is hit, it's ok to delete if temporary
+        if (_adb_long_attr(b, "temporary")) {
+            r = PyObject_CallMethod(b, "deleteMe", NULL);
+            if (r == NULL) {
+                PyErr_Clear();
+            } else {
+                Py_DECREF(r);
+            }
+        }
+        result = 1;
+        break;
+    }
+    Py_DECREF(possibles);
+    return result;
+}
+
 static long _adbobj_break_here(AdbObject *self, PyFrameObject *frame,
                                PyObject *arg, char *type)
 {
     PyObject *tuple;
     PyObject *bp;
     PyObject *flag;
+    PyObject *filename;
 
 #ifdef DEBUG_PRINT
     fprintf(stderr, "_adbobj_break_here...\n");
 #endif
+    // line events are the ones we see all the time, check them here once
+    // we know the canonic filename
+    if (type[0] == '\0' && __adb_candidateCache != NULL) {
+        filename = PyDict_GetItem(__adb_canonicCache,
+                                  frame->f_code->co_filename);
+        if (filename != NULL) {
+            if (PyDict_GetItem(__adb_breakpointFileList, filename) == NULL) {
+                // effective() never looks further than this either
+                return 0;
+            }
+            return _adbobj_effective_line(self, frame, filename);
+        }
+    }
+
     // do a basic fast test to see if we have possible breakpoints, if we do
     // then we will go the slow road and call effective.
-    if (_adbobj_have_possible_break(self, frame) == 0) {
+    if (_adbobj_have_possible_break(self, frame, type) == 0) {
         return 0;
     }
     
@@ -243,12 +465,27 @@ static long _adbobj_break_here(AdbObject *self, PyFrameObject *frame,
     return 0;
 }
 
+static void
+_adbobj_clear_exception(AdbObject *self)
+{
+    Py_DECREF(self->exceptionFrame);
+    Py_INCREF(Py_None);
+    self->exceptionFrame = Py_None;
+    Py_DECREF(self->exceptionInfo);
+    Py_INCREF(Py_None);
+    self->exceptionInfo = Py_None;
+}
+
 static int
 _adbobj_dispatch_line(AdbObject *self, PyFrameObject *frame, PyObject *arg)
 {
 #ifdef DEBUG_PRINT
     fprintf(stderr, "_adbobj_dispatch_line...\n");
 #endif
+    if ((PyObject *)frame == self->exceptionFrame) {
+        // it was handled here
+        _adbobj_clear_exception(self);
+    }
     //if self.stop_here(frame) or self.break_here(frame):
     //    self.dispatch_interaction(frame)
     if (_adbobj_stop_here(self, frame) ||
@@ -325,13 +562,28 @@ _adbobj_dispatch_return(AdbObject *self, PyFrameObject *frame, PyObject *arg)
 #ifdef DEBUG_PRINT
     fprintf(stderr, "_adbobj_dispatch_return...\n");
 #endif
+    PyObject *exc = NULL;
+    int stop;
+
+    if ((PyObject *)frame == self->exceptionFrame) {
+        /* no line since the exception, so it is leaving this frame if
+         * the return value is None */
+        if (arg == Py_None) {
+            exc = self->exceptionInfo;
+            Py_INCREF(exc);
+        }
+        _adbobj_clear_exception(self);
+    }
     /*if self.stop_here(frame) or frame == self.returnframe or \
      *   self.break_here(frame, arg, 'return'):
      *    self.dispatch_interaction(frame, arg)
      */
-    if ((PyObject *)frame == self->returnframe ||
-        _adbobj_stop_here(self, frame) ||
-        _adbobj_break_here(self, frame, arg, "return")) {
+    stop = (PyObject *)frame == self->returnframe ||
+           _adbobj_stop_here(self, frame) ||
+           _adbobj_break_here(self, frame, arg, "return") ||
+           (exc != NULL && _adbobj_break_here(self, frame, exc, "unwind"));
+    Py_XDECREF(exc);
+    if (stop) {
         PyObject *r = PyObject_CallMethod((PyObject *)self,
                                           "dispatch_interaction",
                                           "O", (PyObject *)frame);
@@ -352,6 +604,12 @@ _adbobj_dispatch_exception(AdbObject *self, PyFrameObject *frame, PyObject *arg)
 #ifdef DEBUG_PRINT
     fprintf(stderr, "_adbobj_dispatch_exception...\n");
 #endif
+    Py_DECREF(self->exceptionFrame);
+    Py_INCREF(frame);
+    self->exceptionFrame = (PyObject *)frame;
+    Py_DECREF(self->exceptionInfo);
+    Py_INCREF(arg);
+    self->exceptionInfo = arg;
     //if self.stop_here(frame) or self.break_here(frame, arg, 'exception'):
     //    self.dispatch_interaction(frame)
     if (_adbobj_stop_here(self, frame) ||
@@ -388,6 +646,30 @@ _adbobj_trace_dispatch(AdbObject* self, PyFrameObject *frame,
         PyErr_SetObject(PyExc_DBGPQuit, 0);
         return -1;
     }
+
+    // while stepping, count how deep the stack is so stop_here does not
+    // have to walk it
+    if (self->stackDepth < 0) {
+        if (_adbobj_is_stepping(self)) {
+            self->stackDepth = _adb_frame_depth(frame);
+        }
+    } else if (what == PyTrace_CALL) {
+        self->stackDepth++;
+    }
+    self->frameDepth = self->stackDepth;
+    if (self->stackDepth >= 0) {
+        if ((PyObject *)frame == self->stopframe) {
+            // a generator frame is back on the stack, or has left it
+            if (what == PyTrace_CALL) {
+                self->stopframeDepth = self->frameDepth;
+            } else if (what == PyTrace_RETURN) {
+                self->stopframeDepth = -1;
+            }
+        }
+        if (what == PyTrace_RETURN) {
+            self->stackDepth--;
+        }
+    }
     
     if (_adbobj_trace_skip(self, frame) == 1) {
 #ifdef DEBUG_PRINT
@@ -455,6 +737,11 @@ _adbobj_trace_trampoline(AdbObject *self, PyFrameObject *frame, int what,
 #ifdef DEBUG_PRINT
     fprintf(stderr, "_adbobj_trace_trampoline...\n");
 #endif
+    // the return event of a frame an exception leaves has no arg, python
+    // trace functions (and dbgp.client.effective) get None for it
+    if (arg == NULL) {
+        arg = Py_None;
+    }
     PyFrame_FastToLocals(frame);
     result = _adbobj_trace_dispatch(self, frame, what, arg);
     PyFrame_LocalsToFast(frame, 1);
@@ -517,6 +804,8 @@ adbobj_dealloc(AdbObject *self)
     Py_DECREF(self->stopframe);
     Py_DECREF(self->botframe);
     Py_DECREF(self->returnframe);
+    Py_DECREF(self->exceptionFrame);
+    Py_DECREF(self->exceptionInfo);
     Py_DECREF(__dbgpClientModule);
     PyObject_Del((PyObject *)self);
 #ifdef DEBUG_PRINT
@@ -538,6 +827,10 @@ adbobj_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
         self->interrupt = 0;
         self->quitting = 0;
         self->botframeBehaviour = BOTFRAME_STEP;
+        self->stackDepth = -1;
+        self->frameDepth = -1;
+        self->stopframeDepth = -1;
+        self->botframeDepth = -1;
     
         Py_INCREF(Py_None);
         self->botframe = Py_None;
@@ -545,11 +838,23 @@ adbobj_new(PyTypeObject *type, PyObject *args, PyObject *kwds)
         self->stopframe = Py_None;
         Py_INCREF(Py_None);
         self->returnframe = Py_None;
+        Py_INCREF(Py_None);
+        self->exceptionFrame = Py_None;
+        Py_INCREF(Py_None);
+        self->exceptionInfo = Py_None;
     }
     // only import dbgpClient when the first object is created
     if (__dbgpClientModule == NULL) {
         // import the module so we can call some module level functions
         __dbgpClientModule = PyImport_ImportModule("dbgp.client");
+        __adb_candidateCache = PyObject_GetAttrString(__dbgpClientModule,
+                                                      "_candidateCache");
+        if (__adb_candidateCache == NULL || !PyDict_Check(__adb_candidateCache)) {
+            PyErr_Clear();
+            Py_XDECREF(__adb_candidateCache);
+            __adb_candidateCache = NULL;
+        }
+        __adb_candidateKey = Py_BuildValue("(OOs)", Py_None, Py_None, "");
     }
     if (PyExc_DBGPQuit == NULL) {
         PyObject *mod = PyImport_ImportModule("dbgp.common");
@@ -582,6 +887,12 @@ static PyMemberDef adbobj_members[] = {
     {"botframe", T_OBJECT_EX, offsetof(AdbObject, botframe), 0, ""},
     {"stopframe",   T_OBJECT_EX, offsetof(AdbObject, stopframe), 0, ""},
     {"returnframe",  T_OBJECT_EX, offsetof(AdbObject, returnframe), 0, ""},
+    {"exceptionFrame",  T_OBJECT_EX, offsetof(AdbObject, exceptionFrame), 0, ""},
+    {"exceptionInfo",  T_OBJECT_EX, offsetof(AdbObject, exceptionInfo), 0, ""},
+    {"stackDepth",  T_LONG, offsetof(AdbObject, stackDepth), 0, ""},
+    {"frameDepth",  T_LONG, offsetof(AdbObject, frameDepth), 0, ""},
+    {"stopframeDepth",  T_LONG, offsetof(AdbObject, stopframeDepth), 0, ""},
+    {"botframeDepth",  T_LONG, offsetof(AdbObject, botframeDepth), 0, ""},
     {NULL}
 };
 
@@ -688,9 +999,30 @@ static PyObject* adb_setLocal(PyObject* unused, PyObject* args) {
     return Py_None;
 }
 
+PyDoc_STRVAR(adb_setHideChildren__doc__,
+"setHideChildren(hide) -> previous setting\n\
+skip every frame while the debugger runs code of its own.");
+
+static PyObject* adb_setHideChildren(PyObject* unused, PyObject* args) {
+    PyObject *hide = NULL;
+    long orig = __adb_hideChildren;
+    int result;
+
+    if (!PyArg_ParseTuple(args, "O:setHideChildren", &hide)) {
+        return NULL;
+    }
+    result = PyObject_IsTrue(hide);
+    if (result == -1) {
+        return NULL;
+    }
+    __adb_hideChildren = result;
+    return PyBool_FromLong(orig);
+}
+
 static struct PyMethodDef __adb_methods[] = {
     {"_client", adb_Adb,  METH_VARARGS, adb_Adb__doc__},
     {"setlocal", adb_setLocal,  METH_VARARGS, adb_setLocal__doc__},
+    {"setHideChildren", adb_setHideChildren,  METH_VARARGS, adb_setHideChildren__doc__},
     {0, 0, 0, 0}
 };
 
@@ -700,7 +1032,7 @@ PyDoc_STRVAR(adb_doc,
 This module provides fast optimizations for the DBGP debugger module.");
 
 PyMODINIT_FUNC
-init_client(void)
+ADB_INIT(CLIENT_MODULE)(void)
 {
     PyObject *m;
 
@@ -708,7 +1040,7 @@ init_client(void)
     fprintf(stderr, "init_client...\n");
 #endif
     AdbType.ob_type = &PyType_Type;
-    m = Py_InitModule3("_client", __adb_methods, adb_doc);
+    m = Py_InitModule3(ADB_STR(CLIENT_MODULE), __adb_methods, adb_doc);
 
     Py_INCREF(&AdbType);
     PyModule_AddObject(m, "clientBase", (PyObject *)&AdbType);
@@ -725,6 +1057,10 @@ init_client(void)
     Py_INCREF(__adb_canonicCache);
     PyModule_AddObject(m, "canonicCache", __adb_canonicCache);
 
+    __adb_skipCache = PyDict_New();
+    Py_INCREF(__adb_skipCache);
+    PyModule_AddObject(m, "skipCache", __adb_skipCache);
+
     __adb_breakpointFileList = PyDict_New();
     Py_INCREF(__adb_breakpointFileList);
     PyModule_AddObject(m, "breakpointsByFile", __adb_breakpointFileList);
@@ -733,6 +1069,14 @@ init_client(void)
     Py_INCREF(__adb_breakpointList);
     PyModule_AddObject(m, "breakpointList", __adb_breakpointList);
 
+    __adb_breakpointsByFunction = PyDict_New();
+    Py_INCREF(__adb_breakpointsByFunction);
+    PyModule_AddObject(m, "breakpointsByFunction", __adb_breakpointsByFunction);
+
+    __adb_breakpointsByException = PyDict_New();
+    Py_INCREF(__adb_breakpointsByException);
+    PyModule_AddObject(m, "breakpointsByException", __adb_breakpointsByException);
+
     PyModule_AddIntConstant(m, "BOTFRAME_STEP", BOTFRAME_STEP);
     PyModule_AddIntConstant(m, "BOTFRAME_CONTINUE", BOTFRAME_CONTINUE);
 #ifdef DEBUG_PRINT
@@ -40,7 +40,27 @@ ignoreModules = []
 debugAll = 0
 breakpointList = {}
 breakpointsByFile = {}
+breakpointsByFunction = {}
+breakpointsByException = {}
 canonicCache = {}
+# code object -> (globals, skip) for clientBase.trace_skip.  It holds on
+# to code and globals, so it is emptied when it gets to skipCacheSize
+# entries and when the ignore filter or the breakpoints change
+skipCache = {}
+skipCacheSize = 10000
+# set while the debugger runs code of its own, see setHideChildren
+hideChildren = 0
+
+def setHideChildren(hide):
+    # XXX bug 35933 and bug 44620
+    # while the debugger writes to the redirected stdout (or connects,
+    # or shuts down) we must not stop in, or step into, whatever it calls.
+    # This used to be found by walking the stack for DBGPHideChildren on
+    # every trace event.  Returns the previous setting.
+    global hideChildren
+    orig = hideChildren
+    hideChildren = hide
+    return orig
 
 def setlocal(frame, varname, value):
     # locals are readonly from python, so nothing we can do here!
@@ -53,36 +73,62 @@ class clientBase:
         self.botframeBehaviour = BOTFRAME_STEP
         # 2.3 or higher changed how the debugger works slightly
         self.breakOnFirstCall = not (sys.hexversion < 0x020300F0)
+        # the frame the last exception event was in and its arg, until we
+        # know whether that frame handled it
+        self.exceptionFrame = None
+        self.exceptionInfo = None
         self.reset()
     
     def trace_skip(self, frame):
-        if not frame or not frame.f_globals or \
-            frame.f_lineno == 0 or \
-            frame.f_globals.has_key('DBGPHide') or \
-           (frame.f_globals.has_key('__name__') and \
-            ignoreModules and \
-            frame.f_globals['__name__'] in ignoreModules):
+        if hideChildren or not frame or frame.f_lineno == 0:
             return 1
-        
-        # XXX bug 35933 and bug 44620
-        # If this is not present, you end up having to
-        # step a dozen or so times on a single print statment
-        # the old way of doing this (fixed bug 35993) was extremely slow,
-        # this method seems to make little or no difference in performance
-        f = frame
-        while f and f.f_back:
-            if f.f_globals.has_key('DBGPHideChildren'):
-                return f.f_globals['DBGPHideChildren']
-            f = f.f_back
-        return 0
+        return self.trace_skip_code(frame)
+
+    def trace_skip_code(self, frame):
+        # whether a module is hidden or ignored doesn't change, so remember
+        # it for each code object.  The same code can be run with other
+        # globals (exec), so those must match too.
+        globals = frame.f_globals
+        cached = skipCache.get(frame.f_code)
+        if cached is not None and cached[0] is globals:
+            return cached[1]
+        skip = not globals or globals.has_key('DBGPHide')
+        if not skip and ignoreModules:
+            from dbgp.client import moduleIgnored
+            skip = moduleIgnored(globals, frame.f_code)
+        if len(skipCache) >= skipCacheSize:
+            skipCache.clear()
+        skipCache[frame.f_code] = (globals, skip)
+        return skip
 
     def trace_dispatch(self, frame, event, arg):
-        # if our parent tells us to hide, carry that into our globals as well.
-        # this helps perf in trace_skip somewhat
-        if frame and frame.f_back and frame.f_back.f_globals.has_key('DBGPHideChildren'):
-            frame.f_globals['DBGPHideChildren'] = frame.f_back.f_globals['DBGPHideChildren']
+        # while stepping, count how deep the stack is so stop_here does not
+        # have to walk it.  A frame we see called while stepping is traced,
+        # so we also see it return, or the count is dropped.
+        if self.stackDepth < 0:
+            if self.is_stepping():
+                self.stackDepth = getFrameDepth(frame)
+        elif event == 'call':
+            self.stackDepth = self.stackDepth + 1
+        self.frameDepth = self.stackDepth
+        if self.stackDepth >= 0:
+            if frame is self.stopframe:
+                # a generator frame is back on the stack, or has left it
+                if event == 'call':
+                    self.stopframeDepth = self.frameDepth
+                elif event == 'return':
+                    self.stopframeDepth = -1
+            if event == 'return':
+                self.stackDepth = self.stackDepth - 1
         
         if self.trace_skip(frame):
+            if event == 'call' and frame and self.trace_skip_code(frame):
+                # no local trace function for code we always skip.  We then
+                # don't see it return, so the stack depth has to be counted
+                # again.  Frames called while hideChildren is set (by any
+                # thread) keep theirs, they may stop once it is cleared.
+                self.stackDepth = -1
+                return None
             return self.trace_dispatch
         # see if we're getting a break or something
         #log.debug("trace_dispatch event=%r", event)
@@ -129,6 +175,9 @@ class clientBase:
         sys.settrace(None)
 
     def dispatch_line(self, frame, arg):
+        if frame is self.exceptionFrame:
+            # it was handled here
+            self.exceptionFrame = self.exceptionInfo = None
         # if we need to break or stop on this line, then do it
         if self.stop_here(frame) or self.break_here(frame):
             self.dispatch_interaction(frame)
@@ -146,29 +195,91 @@ class clientBase:
            self.break_here(frame, arg, 'call'):
             self.dispatch_interaction(frame, arg)
             if self.quitting: raise DBGPQuit
-        return self.trace_dispatch
+        # the call event always reaches us through the global trace
+        # function, but line, return and exception events only happen
+        # if we hand back a local trace function.  Don't do that for
+        # frames that can never stop, they then run at nearly full speed.
+        # Stepping into, any frame can stop.  Stepping over or out, only
+        # frames stop_here stops in and the frame we step out of, the
+        # others are below stopframe.
+        if self.frame_can_break(frame) or \
+           (self.is_stepping() and
+            (self.stopframe is None or frame is self.returnframe or
+             self.stop_here(frame))):
+            return self.trace_dispatch
+        # we won't see it return, the stack depth has to be counted again
+        self.stackDepth = -1
+        return None
 
     def dispatch_return(self, frame, arg):
+        unwinding = 0
+        if frame is self.exceptionFrame:
+            # no line since the exception, so it is leaving this frame
+            # (the return value is None then)
+            exc = self.exceptionInfo
+            self.exceptionFrame = self.exceptionInfo = None
+            unwinding = arg is None
         # if we need to break or stop when returning from this
         # function call, do it now
         if self.stop_here(frame) or frame == self.returnframe or \
-           self.break_here(frame, arg, 'return'):
+           self.break_here(frame, arg, 'return') or \
+           (unwinding and self.break_here(frame, exc, 'unwind')):
             self.dispatch_interaction(frame, arg)
             if self.quitting: raise DBGPQuit
+        # the caller may have been started without a local trace function,
+        # if we are stepping we need line events when we get back there,
+        # and its exception event to follow an exception further.  Code we
+        # skip is not traced, its caller gets them once it returns.
+        if unwinding or self.is_stepping():
+            caller = frame.f_back
+            while caller is not None and self.trace_skip_code(caller):
+                # we won't see it return either
+                self.stackDepth = -1
+                caller = caller.f_back
+            if caller is not None and caller.f_trace is None:
+                caller.f_trace = self.trace_dispatch
         return self.trace_dispatch
 
     def dispatch_exception(self, frame, arg):
+        self.exceptionFrame = frame
+        self.exceptionInfo = arg
         # if we need to break or stop on an exception, do it now
         if self.stop_here(frame) or self.break_here(frame, arg, 'exception'):
             self.dispatch_interaction(frame, arg)
             if self.quitting: raise DBGPQuit
         return self.trace_dispatch
 
+    def is_stepping(self):
+        # true unless we are in a plain "run", in which case only
+        # breakpoints can stop us
+        return self.stopframe is not None or \
+               self.botframeBehaviour == BOTFRAME_STEP
+
+    def frame_can_break(self, frame):
+        from dbgp.client import codeCanBreak
+        return codeCanBreak(frame.f_code)
+
     def stop_here(self, frame):
         # (CT) stopframe may now also be None, see dispatch_call.
         # (CT) the former test for None is therefore removed from here.
         if frame is self.stopframe:
             return 1
+        if not self.is_stepping():
+            return 0
+        depth = self.frameDepth
+        if depth > 0:
+            # stopframe and botframe are the frames at their depth on our
+            # stack, the nearer one is where walking up the stack would end
+            botDepth = self.botframeDepth
+            if botDepth < 0 and self.botframe is not None:
+                botDepth = self.botframeDepth = getFrameDepth(self.botframe)
+            stopDepth = self.stopframeDepth
+            if self.stopframe is not None and 0 < stopDepth < depth and \
+               not stopDepth < botDepth <= depth:
+                return 0
+            if self.botframe is not None and 0 < botDepth <= depth:
+                return self.botframeBehaviour == BOTFRAME_STEP
+            return 0
         while frame is not None and frame is not self.stopframe:
             if frame is self.botframe:
                 return self.botframeBehaviour == BOTFRAME_STEP
@@ -37,11 +37,11 @@ if sys.hexversion < 0x020000F0:
                      % (exe, ver))
     sys.exit(1)
 
-import socket, copy
-import thread, threading
+import socket, copy, collections
+import thread, threading, time
 # command line host driver
 import getopt, os, types, StringIO, Queue
-import traceback, re
+import traceback, re, inspect
 import base64, urlparse, urllib
 import dbgp.listcmd as listcmd
 
@@ -601,6 +601,16 @@ class h_execfile(h_base):
                 self.resetModule(module)
 
 
+def _hideChildren(hide):
+    # prevent stepping into functions the debugger calls, returns the
+    # previous setting.  get_stack looks at DBGPHideChildren, the tracer
+    # has its own flag so it doesn't have to look at the stack.
+    global DBGPHideChildren
+    origDBGPHideChildren = DBGPHideChildren
+    DBGPHideChildren = hide
+    setHideChildren(hide)
+    return origDBGPHideChildren
+
 class StreamOut:
     # this class is used for copying/redirecting the
     # stdout and stderr streams
@@ -616,20 +626,19 @@ class StreamOut:
         self.__dict__['_origStream'] = origStream
     
     def stop(self):
+        self._client.flush_streams()
         return self._origStream
         
     def write(self, s):
-        global DBGPHideChildren
-        origDBGPHideChildren = DBGPHideChildren
-        DBGPHideChildren = DBGPDebugDebugger is not 2
+        origDBGPHideChildren = _hideChildren(DBGPDebugDebugger is not 2)
         try:
             if type(s)==types.UnicodeType:
                 s = s.encode('UTF-8')
             if not self._redirect:
                 self._origStream.write(s)
-            self._client.send_stream(self._name, s)
+            self._client.write_stream(self._name, s)
         finally:
-            DBGPHideChildren = origDBGPHideChildren
+            _hideChildren(origDBGPHideChildren)
 
     def writelines(self, lines):
         text = ''.join(lines)
@@ -640,6 +649,195 @@ class StreamOut:
             return getattr(self,attr)
         return getattr(self._origStream, attr)
 
+# what StreamSender does with output when the IDE can't keep up:
+#   'block'  the program waits until the IDE has taken some of it
+#   'drop'   the oldest output not yet sent is thrown away
+#   'spill'  output is kept in a temporary file until it can be sent
+streamOverflow = 'block'
+
+def set_stream_overflow(mode):
+    """Select what happens to output the IDE can't keep up with, see
+    streamOverflow.
+
+    Raises DBGPError for an unknown mode.
+    """
+    global streamOverflow
+    if mode not in ['block', 'drop', 'spill']:
+        raise DBGPError('unknown stream overflow mode %r' % mode)
+    streamOverflow = mode
+
+class StreamSender:
+    """Send what StreamOut writes to the IDE from a thread of its own.
+
+    Writes are collected, and the ones to the same stream are sent as
+    one packet once there is flushSize of them, when the oldest is
+    flushTime seconds old, or when flush is called because the debugger
+    is about to stop.  There is at most maxPending of output waiting,
+    streamOverflow says what happens to more.
+    """
+    flushSize = 16384
+    flushTime = 0.05
+    maxPending = 1 << 20
+
+    def __init__(self, client):
+        self._client = client
+        self._lock = threading.Condition()
+        # (stream name, data) in the order they were written
+        self._pending = []
+        self._size = 0
+        self._oldest = None
+        self._sending = 0
+        self._flushing = 0
+        self._stopped = 0
+        self._threadId = None
+        # output that didn't fit in pending with streamOverflow 'spill',
+        # it is written after what is pending
+        self._spill = None
+        self._spillRead = 0
+        self._spillWrite = 0
+        # bytes thrown away with streamOverflow 'drop'
+        self.dropped = 0
+
+    def write(self, name, data):
+        self._lock.acquire()
+        try:
+            if self._stopped:
+                return
+            if self._threadId is None:
+                self._threadId = _nonDebugThread(self._run, ())
+            if self._spillWrite or self._size + len(data) > self.maxPending:
+                if streamOverflow == 'spill':
+                    self._spillData(name, data)
+                    self._lock.notifyAll()
+                    return
+                elif streamOverflow == 'drop':
+                    while self._pending and \
+                          self._size + len(data) > self.maxPending:
+                        self.dropped = self.dropped + len(self._pending[0][1])
+                        self._size = self._size - len(self._pending[0][1])
+                        del self._pending[0]
+                elif thread.get_ident() != self._threadId:
+                    # wait for the sender, unless this is the sender
+                    # writing to a redirected stream
+                    while not self._stopped and self._pending and \
+                          self._size + len(data) > self.maxPending:
+                        self._lock.wait(self.flushTime)
+            if not self._pending:
+                self._oldest = time.time()
+            self._pending.append((name, data))
+            self._size = self._size + len(data)
+            if len(self._pending) == 1 or self._size >= self.flushSize:
+                self._lock.notifyAll()
+        finally:
+            self._lock.release()
+
+    def _spillData(self, name, data):
+        if self._spill is None:
+            import tempfile
+            self._spill = tempfile.TemporaryFile()
+        self._spill.seek(self._spillWrite)
+        self._spill.write('%s %d\n' % (name, len(data)))
+        self._spill.write(data)
+        self._spillWrite = self._spill.tell()
+
+    def _unspill(self):
+        # read back up to maxPending of spilled output
+        chunks = []
+        size = 0
+        self._spill.seek(self._spillRead)
+        while self._spillRead < self._spillWrite and size < self.maxPending:
+            name, length = self._spill.readline().split()
+            data = self._spill.read(int(length))
+            chunks.append((name, data))
+            size = size + len(data)
+            self._spillRead = self._spill.tell()
+        if self._spillRead >= self._spillWrite:
+            self._spill.seek(0)
+            self._spill.truncate()
+            self._spillRead = self._spillWrite = 0
+        return chunks
+
+    def _ready(self):
+        if self._spillWrite:
+            return 1
+        if not self._pending:
+            return 0
+        return self._flushing or self._size >= self.flushSize or \
+               time.time() - self._oldest >= self.flushTime
+
+    def _run(self):
+        while 1:
+            self._lock.acquire()
+            try:
+                while not self._stopped and not self._ready():
+                    if self._pending:
+                        self._lock.wait(self.flushTime)
+                    else:
+                        # nothing to do until something is written
+                        self._lock.wait()
+                if self._stopped:
+                    self._lock.notifyAll()
+                    return
+                if self._pending:
+                    chunks = self._pending
+                    self._pending = []
+                    self._size = 0
+                else:
+                    chunks = self._unspill()
+                self._sending = 1
+                # writers waiting for room can go on
+                self._lock.notifyAll()
+            finally:
+                self._lock.release()
+            try:
+                self._send(chunks)
+            finally:
+                self._lock.acquire()
+                self._sending = 0
+                self._lock.notifyAll()
+                self._lock.release()
+
+    def _send(self, chunks):
+        # one packet for each run of writes to the same stream
+        name = None
+        data = []
+        for chunkName, chunkData in chunks:
+            if chunkName != name and data:
+                self._client.send_stream(name, ''.join(data))
+                data = []
+            name = chunkName
+            data.append(chunkData)
+        if data:
+            self._client.send_stream(name, ''.join(data))
+
+    def flush(self):
+        """Wait until everything written has been sent."""
+        self._lock.acquire()
+        try:
+            self._flushing = self._flushing + 1
+            self._lock.notifyAll()
+            while not self._stopped and \
+                  (self._pending or self._spillWrite or self._sending):
+                self._lock.wait(self.flushTime)
+            self._flushing = self._flushing - 1
+        finally:
+            self._lock.release()
+
+    def stop(self):
+        """Throw away anything not sent and end the sender thread."""
+        self._lock.acquire()
+        try:
+            self._stopped = 1
+            self._pending = []
+            self._size = 0
+            if self._spill is not None:
+                self._spill.close()
+                self._spill = None
+                self._spillRead = self._spillWrite = 0
+            self._lock.notifyAll()
+        finally:
+            self._lock.release()
+
 class StreamStdin:
     # this class is used for doing a notification of stdin reads
     def __init__(self, origStream, client):
@@ -874,10 +1072,17 @@ class Breakpoint:
         # depending on type, self.cond contains an expression,
         # function name or exception name
         self.cond = cond
+
+        # expressions are compiled once here rather than on every line
+        # we check them, this also gets syntax errors to the IDE when
+        # the breakpoint is set
+        self.code = None
+        if cond and type in ['conditional', 'watch']:
+            self.code = compile(cond, '<string>', 'eval')
         
         # if we're a watch bp, then we need to keep the
         # last known value here, so that we can see if
-        # it changes
+        # it changes, see _watchChanged
         self.lastValue = None
         
         self.enabled = enabled
@@ -892,6 +1097,14 @@ class Breakpoint:
             self.number = len(breakpointsByNumber) - 1
         else:
             breakpointsByNumber[self.number] = self
+        byName = self._nameIndex()
+        if byName is not None:
+            if byName.has_key(self.cond):
+                byName[self.cond].append(self)
+            else:
+                byName[self.cond] = [self]
+            _breakpointsChanged()
+            return
         if breakpointList.has_key((self.file, self.line)):
             breakpointList[self.file, self.line].append(self)
         else:
@@ -900,10 +1113,18 @@ class Breakpoint:
             breakpointsByFile[self.file].append(self)
         else:
             breakpointsByFile[self.file] = [self]
+        _breakpointsChanged()
 
     def deleteMe(self):
-        index = (self.file, self.line)
         breakpointsByNumber[self.number] = None   # No longer in list
+        byName = self._nameIndex()
+        if byName is not None:
+            byName[self.cond].remove(self)
+            if not byName[self.cond]:
+                del byName[self.cond]
+            _breakpointsChanged()
+            return
+        index = (self.file, self.line)
         breakpointList[index].remove(self)
         if not breakpointList[index]:
             # No more bp for this f:l combo
@@ -912,12 +1133,33 @@ class Breakpoint:
         if not breakpointsByFile[self.file]:
             # No more bp for this f:l combo
             del breakpointsByFile[self.file]
+        _breakpointsChanged()
+
+    def isFunctionBreakpoint(self):
+        # call and return breakpoints on a named function are kept in
+        # breakpointsByFunction, so they only cost something on calls
+        # and returns of functions with that name
+        return self.type in ['call', 'return'] and self.cond
+
+    def isExceptionBreakpoint(self):
+        # likewise exception breakpoints on a named exception are kept in
+        # breakpointsByException, see exceptionBreakpoints
+        return self.type == 'exception' and self.cond
+
+    def _nameIndex(self):
+        if self.isFunctionBreakpoint():
+            return breakpointsByFunction
+        if self.isExceptionBreakpoint():
+            return breakpointsByException
+        return None
 
     def enable(self):
         self.enabled = 1
+        _breakpointsChanged()
 
     def disable(self):
         self.enabled = 0
+        _breakpointsChanged()
 
     def toxml(self):
         """Return an XML representation of the breakpoint."""
@@ -957,7 +1199,7 @@ def canonic(fname):
     canonic = canonicCache.get(fname)
     if canonic:
         return canonic
-    if fname[0] == "<" and fname[-1] == ">":
+    if fname[:1] == "<" and fname[-1:] == ">":
         canonicCache[fname] = fname
         return fname
     
@@ -980,6 +1222,363 @@ def canonic(fname):
     canonicCache[fname] = canonic
     return canonic
 
+# the "just my code" filter, see set_ignore_modules.  A list of
+# (include, test) where test(module name, canonic filename) is true for
+# the code the entry matches
+_ignoreFilter = []
+
+def _pathPrefix(path):
+    return os.path.join(os.path.normcase(os.path.abspath(path)), '')
+
+def _namedPrefixes(name):
+    # the directories @stdlib, @site-packages and @venv stand for
+    import sysconfig
+    paths = sysconfig.get_paths()
+    if name == 'stdlib':
+        dirs = [paths['stdlib'], paths['platstdlib']]
+    elif name == 'site-packages':
+        dirs = [paths['purelib'], paths['platlib']]
+        try:
+            import site
+            dirs = dirs + site.getsitepackages()
+        except AttributeError:
+            # the site module of old virtualenvs
+            pass
+    elif name == 'venv':
+        base = getattr(sys, 'real_prefix', None) or \
+               getattr(sys, 'base_prefix', sys.prefix)
+        if os.path.normcase(base) == os.path.normcase(sys.prefix):
+            dirs = []
+        else:
+            dirs = [sys.prefix]
+    else:
+        raise DBGPError('unknown directory @%s, use @stdlib, '
+                        '@site-packages or @venv' % name)
+    prefixes = []
+    for dir in dirs:
+        prefix = _pathPrefix(dir)
+        if prefix not in prefixes:
+            prefixes.append(prefix)
+    return prefixes
+
+def _pathTest(prefixes, exclude=[]):
+    def test(name, file):
+        for prefix in exclude:
+            if file.startswith(prefix):
+                return 0
+        for prefix in prefixes:
+            if file.startswith(prefix):
+                return 1
+        return 0
+    return test
+
+def _moduleTest(pattern):
+    import fnmatch
+    def test(name, file):
+        return name is not None and fnmatch.fnmatchcase(name, pattern)
+    return test
+
+def set_ignore_modules(entries):
+    """Set the code the debugger ignores, it is not traced or stepped into.
+
+    Each entry is a module name or glob ("logging", "django.*"), a
+    directory ("/usr/lib/python2.7"), or one of @stdlib, @site-packages
+    and @venv.  Entries starting with "+" are included even when another
+    entry excludes them.  Raises DBGPError for an unknown @ directory.
+    """
+    filter = []
+    for entry in entries:
+        entry = entry.strip()
+        include = entry[:1] == '+'
+        if include:
+            entry = entry[1:]
+        if not entry:
+            continue
+        if entry[:1] == '@':
+            prefixes = _namedPrefixes(entry[1:])
+            if entry == '@stdlib':
+                # site-packages is usually in the stdlib directory
+                test = _pathTest(prefixes, _namedPrefixes('site-packages'))
+            else:
+                test = _pathTest(prefixes)
+        elif '/' in entry or os.sep in entry:
+            test = _pathTest([_pathPrefix(os.path.expanduser(entry))])
+        else:
+            test = _moduleTest(entry)
+        filter.append((include, test))
+    _ignoreFilter[:] = filter
+    ignoreModules[:] = entries
+    # trace_skip remembers what we said for each code object
+    skipCache.clear()
+
+def moduleIgnored(globals, code):
+    """Return true if the filter set with set_ignore_modules excludes code
+    running with globals.
+
+    clientBase.trace_skip only asks once for each code object.
+    """
+    if not _ignoreFilter:
+        return 0
+    name = globals.get('__name__')
+    file = canonic(code.co_filename)
+    ignored = 0
+    for include, test in _ignoreFilter:
+        if test(name, file):
+            if include:
+                return 0
+            ignored = 1
+    return ignored
+
+# code object -> true if a frame running that code may hit a breakpoint.
+# Cleared whenever the breakpoints change, see _breakpointsChanged
+_codeBreakCache = {}
+
+# the breakpoint caches are emptied when they get this big, they may hold
+# on to code objects
+_maxCacheSize = 10000
+
+def _remember(cache, key, value):
+    if len(cache) >= _maxCacheSize:
+        cache.clear()
+    cache[key] = value
+    return value
+
+def _codeLines(code):
+    import dis
+    lines = {code.co_firstlineno: 1}
+    for offset, lineno in dis.findlinestarts(code):
+        lines[lineno] = 1
+    return lines
+
+def _codeCanBreak(code):
+    # call events are sent to the global trace function, but we need a
+    # local one to see the return
+    if functionBreakpoints(code, 'return'):
+        return 1
+    file = canonic(code.co_filename)
+    # exception events also need a local trace function
+    for bps in breakpointsByException.values():
+        for bp in bps:
+            if bp.enabled and (not bp.file or bp.file == file):
+                return 1
+    if not breakpointsByFile.has_key(file):
+        # effective() never looks further than this either
+        return 0
+    lines = None
+    for bp in breakpointsByFile[file] + breakpointsByFile.get('', []):
+        if not bp.enabled:
+            continue
+        if bp.line:
+            if lines is None:
+                try:
+                    lines = _codeLines(code)
+                except:
+                    # no line table (jython?), be safe
+                    return 1
+            if lines.has_key(bp.line):
+                return 1
+            continue
+        # exception, conditional and watch breakpoints without a line
+        # (and call or return breakpoints without a function name) can
+        # happen anywhere in the file
+        return 1
+    return 0
+
+def codeCanBreak(code):
+    """Return true if a frame executing code may stop on a breakpoint.
+
+    Frames for which this is false do not need a local trace function
+    unless we are stepping.
+    """
+    try:
+        return _codeBreakCache[code]
+    except KeyError:
+        return _remember(_codeBreakCache, code, _codeCanBreak(code))
+
+# (file, line, event type) -> tuple of the enabled breakpoints effective()
+# has to look at there, (code filename, code names, event type) -> the
+# call or return breakpoints for code, and (code filename, 'exception',
+# exception class) -> the exception breakpoints.  Cleared whenever the
+# breakpoints change.
+_candidateCache = {}
+
+def _candidates(file, line, type):
+    possibles = breakpointList.get((file, line), []) + \
+                breakpointList.get((file, 0), []) + \
+                breakpointList.get(('', 0), [])
+    # reduce list by type if we have a type
+    return tuple([bp for bp in possibles
+                  if bp.enabled and (not type or bp.type == type)])
+
+def candidates(file, line, type):
+    """Return the enabled breakpoints effective() looks at for an event
+    of type on file:line."""
+    key = (file, line, type)
+    possibles = _candidateCache.get(key)
+    if possibles is None:
+        possibles = _remember(_candidateCache, key,
+                              _candidates(file, line, type))
+    return possibles
+
+def _codeNames(code):
+    # the names a call or return breakpoint can use for this code
+    qualname = getattr(code, 'co_qualname', None)
+    if qualname and qualname != code.co_name:
+        return (code.co_name, qualname)
+    return (code.co_name,)
+
+def _functionBreakpoints(code, type):
+    file = None
+    possibles = []
+    for name in _codeNames(code):
+        for bp in breakpointsByFunction.get(name, []):
+            if not bp.enabled or bp.type != type:
+                continue
+            if bp.file:
+                if file is None:
+                    file = canonic(code.co_filename)
+                if bp.file != file:
+                    continue
+            possibles.append(bp)
+    return tuple(possibles)
+
+def functionBreakpoints(code, type):
+    """Return the enabled call or return breakpoints set on the
+    function running code."""
+    if not breakpointsByFunction:
+        return ()
+    # the names and the file decide, not the code object
+    key = (code.co_filename, _codeNames(code), type)
+    possibles = _candidateCache.get(key)
+    if possibles is None:
+        possibles = _remember(_candidateCache, key,
+                              _functionBreakpoints(code, type))
+    return possibles
+
+# exception class -> the names exception breakpoints can use for it and
+# its base classes, most derived first
+_exceptionNameCache = {}
+
+def _exceptionNames(exc):
+    try:
+        return _exceptionNameCache[exc]
+    except KeyError:
+        pass
+    except TypeError:
+        # not hashable, can't be a class
+        return ()
+    try:
+        mro = inspect.getmro(exc)
+    except:
+        # a string exception
+        mro = ()
+    if not mro:
+        names = (str(exc),)
+    else:
+        names = []
+        for cls in mro:
+            names.append(cls.__name__)
+            names.append('%s.%s' % (cls.__module__, cls.__name__))
+        names = tuple(names)
+    _exceptionNameCache[exc] = names
+    return names
+
+def _exceptionBreakpoints(exc, code):
+    file = None
+    possibles = []
+    for name in _exceptionNames(exc):
+        for bp in breakpointsByException.get(name, []):
+            if not bp.enabled or bp in possibles:
+                continue
+            if bp.file:
+                if file is None:
+                    file = canonic(code.co_filename)
+                if bp.file != file:
+                    continue
+            possibles.append(bp)
+    return tuple(possibles)
+
+def exceptionBreakpoints(exc, code):
+    """Return the enabled exception breakpoints set on exception class exc
+    or one of its base classes that apply to the frame running code."""
+    if not breakpointsByException:
+        return ()
+    key = (code.co_filename, 'exception', exc)
+    try:
+        possibles = _candidateCache.get(key)
+    except TypeError:
+        return ()
+    if possibles is None:
+        possibles = _remember(_candidateCache, key,
+                              _exceptionBreakpoints(exc, code))
+    return possibles
+
+# when exception breakpoints stop:
+#   'raise'     where the exception is raised, and in every frame it
+#               passes through
+#   'uncaught'  when it gets back to the debugger (or to threading, which
+#               swallows whatever a thread raises), ie. nothing caught it
+#   'user'      when it leaves the code being debugged for code that is
+#               not traced, or is not caught at all
+exceptionBreakMode = 'raise'
+
+def set_exception_break_mode(mode):
+    """Select when exception breakpoints stop, see exceptionBreakMode.
+
+    Raises DBGPError for an unknown mode.
+    """
+    global exceptionBreakMode
+    if mode not in ['raise', 'uncaught', 'user']:
+        raise DBGPError('unknown exception break mode %r' % mode)
+    exceptionBreakMode = mode
+
+def _exceptionEscapes(frame):
+    # is the exception leaving frame getting out of the debugged code?
+    caller = frame.f_back
+    if caller is None or caller.f_globals.has_key('DBGPHide'):
+        return 1
+    name = caller.f_globals.get('__name__')
+    if name == 'threading':
+        return 1
+    if exceptionBreakMode == 'user':
+        return moduleIgnored(caller.f_globals, caller.f_code)
+    return 0
+
+def _breakpointsChanged():
+    _codeBreakCache.clear()
+    _candidateCache.clear()
+    # not affected by breakpoints, but a good time to let go of the code
+    # and globals it holds on to
+    skipCache.clear()
+    if not hasattr(sys, '_current_frames'):
+        return
+    # frames that are already running may have been started without a
+    # local trace function, give them one if they can break now.  The C
+    # module sees every event of every frame and has no trace_dispatch.
+    for tid, frame in sys._current_frames().items():
+        client = _clientInstances.get(tid)
+        if not client or not client.dbg or \
+           not hasattr(client.dbg, 'trace_dispatch'):
+            continue
+        while frame is not None:
+            if frame.f_trace is None and codeCanBreak(frame.f_code):
+                frame.f_trace = client.dbg.trace_dispatch
+            frame = frame.f_back
+
+def _watchChanged(b, value):
+    # has the value of watch breakpoint b's expression changed?  The same
+    # object, or one equal to it, is no change.  The identity test saves
+    # comparing a big container with its old self on every line.  As
+    # before, changes made inside the same object are not noticed.
+    last = b.lastValue
+    if value is last:
+        return 0
+    try:
+        return not (value == last)
+    except:
+        # can't compare them (numpy arrays), it is another object
+        return 1
+
 # Determines if there is an effective (active) breakpoint at this
 # line of code.  Returns breakpoint number or 0 if none
 def effective(frame, arg, type):
@@ -989,96 +1588,109 @@ def effective(frame, arg, type):
     that indicates if it is ok to delete a temporary bp.
 
     """
+    if type == 'exception':
+        if exceptionBreakMode != 'raise':
+            # wait and see if it gets out, see clientBase.dispatch_return
+            return (None, None)
+    elif type == 'unwind':
+        # arg is an exception frame did not handle
+        if exceptionBreakMode == 'raise' or not _exceptionEscapes(frame):
+            return (None, None)
+        type = 'exception'
+
+    if type in ['call', 'return']:
+        possibles = functionBreakpoints(frame.f_code, type)
+        if possibles:
+            (bp, flag) = _effective(possibles, frame, arg, type)
+            if bp:
+                return (bp, flag)
+    elif type == 'exception':
+        possibles = exceptionBreakpoints(arg[0], frame.f_code)
+        if possibles:
+            (bp, flag) = _effective(possibles, frame, arg, type)
+            if bp:
+                return (bp, flag)
+
     file = canonic(frame.f_code.co_filename)
     if not breakpointsByFile.has_key(file):
         return (None, None)
 
-    line = frame.f_lineno
-    
-    possibles = []
-    if breakpointList.has_key((file, line)):
-        possibles += breakpointList[file, line]
-    if breakpointList.has_key((file, 0)):
-        possibles += breakpointList[file, 0]
-    if breakpointList.has_key(('', 0)):
-        possibles += breakpointList['', 0]
-        
-    # reduce list by type if we have a type
-    if type:
-        possibles = [bp for bp in possibles if bp.type == type]
-
+    possibles = candidates(file, frame.f_lineno, type)
     if not possibles:
         return (None, None)
+    return _effective(possibles, frame, arg, type)
 
-    exNames = None
+def breakpointCondition(b, frame, arg, type):
+    """Check the condition (expression, function or exception name) of
+    breakpoint b, which must have one.
 
-    for i in range(0, len(possibles)):
-        b = possibles[i]
-        if b.enabled == 0:
-            continue
+    Returns 1 if the breakpoint is hit, 0 if not, and -1 if the condition
+    could not be evaluated.
+    """
+    if b.type == 'conditional':
+        # Conditional bp.
+        # hits and hitValue applies only to those bp
+        # hits where the condition evaluates to true.
+        try:
+            val = eval(b.code, frame.f_globals,
+                   frame.f_locals)
+        except:
+            # if eval fails, most conservative
+            # thing is to stop on breakpoint
+            # regardless of ignore count.
+            return -1
+        if not val:
+            # conditionals are only a hit if they
+            # eval to true, so continue to the
+            # next breakpoint
+            return 0
+
+    elif b.type == 'watch':
+        # for watched breaks, we eval the condition, and if it
+        # is not the same as the last value, then it has changed
+        # and we must break.
         
-        val = None
-        if b.cond:
-            if b.type == 'conditional':
-                # Conditional bp.
-                # hits and hitValue applies only to those bp
-                # hits where the condition evaluates to true.
-                try:
-                    val = eval(b.cond, frame.f_globals,
-                           frame.f_locals)
-                except:
-                    # if eval fails, most conservative
-                    # thing is to stop on breakpoint
-                    # regardless of ignore count.
-                    # Don't delete temporary,
-                    # as another hint to user.
-                    return (b, 0)
-                if not val:
-                    # conditionals are only a hit if they
-                    # eval to true, so continue to the
-                    # next breakpoint
-                    continue
+        # this does not exactly match a watch where you want to
+        # break when a value changes, but is as close an
+        # aproximation as we can get until python supports this
+        # internally.
+        try:
+            value = eval(b.code, frame.f_globals, frame.f_locals)
+        except:
+            # we don't care about any exceptions here, we just
+            # want a value if it exists
+            return 0
 
-            elif b.type == 'watch':
-                # for watched breaks, we eval the condition, and if it
-                # is not the same as the last value, then it has changed
-                # and we must break.
-                
-                # this does not exactly match a watch where you want to
-                # break when a value changes, but is as close an
-                # aproximation as we can get until python supports this
-                # internally.
-                try:
-                    value = eval(b.cond, frame.f_globals, frame.f_locals)
-                except:
-                    # we don't care about any exceptions here, we just
-                    # want a value if it exists
-                    continue
+        if not _watchChanged(b, value):
+            return 0
+        b.lastValue = value
         
-                if value == b.lastValue:
-                    continue
-                b.lastValue = value
-                
-            elif type:
-                # we'll only do these if a type was defined
-                if b.type in ['call', 'return']:
-                    # arg is none for call
-                    # arg is return type for return
-                    if frame.f_code.co_name != b.cond:
-                        continue
-                elif b.type == 'exception':
-                    # arg = (exception, value, traceback)
-                    if not exNames:
-                        # if we cannot get the exception names, then
-                        # return no breakpoint
-                        exNames = _class_names(arg[0])
-                        if not exNames:
-                            return (None, None)
-                    if b.cond not in exNames.values():
-                        continue
-                else:
-                    continue
-            else:
+    elif type:
+        # we'll only do these if a type was defined
+        if b.type in ['call', 'return']:
+            # arg is none for call
+            # arg is return type for return
+            if b.cond not in _codeNames(frame.f_code):
+                return 0
+        elif b.type == 'exception':
+            # arg = (exception, value, traceback)
+            if b.cond not in _exceptionNames(arg[0]):
+                return 0
+        else:
+            return 0
+    else:
+        return 0
+    return 1
+
+def _effective(possibles, frame, arg, type):
+    for b in possibles:
+        if b.cond:
+            hit = breakpointCondition(b, frame, arg, type)
+            if hit < 0:
+                # Don't delete temporary,
+                # as another hint to user.
+                return (b, 0)
+            if not hit:
                 continue
 
         # Count every hit when bp is enabled
@@ -1107,6 +1719,255 @@ def effective(frame, arg, type):
         return (b, 1)
     return (None, None)
 
+class _reprLimitReached(Exception):
+    pass
+
+class boundedRepr:
+    """repr() that stops once it has made maxdata characters.
+
+    The result is repr(value)[:maxdata], but only as much of a list,
+    tuple, dict, set or string is looked at as that needs, instead of
+    making the repr of all of it and throwing most of it away.  Other
+    types use their own repr.
+    """
+
+    def __init__(self, maxdata):
+        self.maxdata = maxdata
+
+    def repr(self, value):
+        self.parts = []
+        self.size = 0
+        # ids of the containers we are in, to stop on recursive ones
+        self.active = {}
+        try:
+            self._repr(value)
+        except _reprLimitReached:
+            pass
+        return ''.join(self.parts)[:self.maxdata]
+
+    def _write(self, data):
+        self.parts.append(data)
+        self.size = self.size + len(data)
+        if self.size >= self.maxdata:
+            raise _reprLimitReached()
+
+    def _repr(self, value):
+        method = self._methods.get(type(value))
+        if method is None:
+            self._write(repr(value))
+        else:
+            method(self, value)
+
+    def _items(self, value, open, close, writeItem):
+        if self.active.has_key(id(value)):
+            self._write(open + '...' + close)
+            return
+        self.active[id(value)] = 1
+        self._write(open)
+        sep = ''
+        for item in value:
+            self._write(sep)
+            writeItem(item)
+            sep = ', '
+        self._write(close)
+        del self.active[id(value)]
+
+    def _repr_list(self, value):
+        self._items(value, '[', ']', self._repr)
+
+    def _repr_tuple(self, value):
+        if len(value) == 1:
+            self._items(value, '(', ',)', self._repr)
+        else:
+            self._items(value, '(', ')', self._repr)
+
+    def _repr_dict(self, value):
+        def writeItem(key):
+            self._repr(key)
+            self._write(': ')
+            self._repr(value[key])
+        self._items(value, '{', '}', writeItem)
+
+    def _repr_set(self, value):
+        name = type(value).__name__
+        if self.active.has_key(id(value)):
+            self._write(name + '(...)')
+            return
+        self._items(value, name + '([', '])', self._repr)
+
+    def _repr_string(self, value):
+        room = self.maxdata - self.size
+        if len(value) <= room:
+            self._write(repr(value))
+            return
+        # every character is at least one more character of repr, so
+        # the head is enough.  repr quotes with " when a string has '
+        # but no ", make the head quote the same way the whole would
+        head = value[:room]
+        double = "'" in value and '"' not in value
+        if "'" in head and '"' not in head and not double:
+            data = repr(head + '"')[:-2]
+        else:
+            data = repr(head)[:-1]
+            if double and "'" not in head:
+                data = data.replace("'", '"', 1)
+        self._write(data)
+
+    _methods = {types.ListType: _repr_list,
+                types.TupleType: _repr_tuple,
+                types.DictType: _repr_dict}
+    for _typ in StringTypes:
+        _methods[_typ] = _repr_string
+    del _typ
+    try:
+        _methods[set] = _repr_set
+        _methods[frozenset] = _repr_set
+    except NameError:
+        # older python
+        pass
+
+class propertySerializer:
+    """How Property shows values of a type.
+
+    The default works from dir() of the value: attributes that are not
+    private or of a hidden type are children, and values with __getitem__
+    have their items as children, by key if they have keys() and by
+    index if they have __len__.  Subclass it for container types this
+    doesn't show well and register it with register_serializer.
+    """
+
+    def attributes(self, prop):
+        """Return (name, value) of the attributes shown as children of
+        prop, value is None if getting the attribute failed."""
+        attributes = []
+        for childStr in prop._get_dir():
+            if ((not prop.include_private) and \
+               (childStr[:1] == '_')) or \
+               childStr == "__builtins__":
+                continue
+            try:
+                cvalue = getattr(prop.value, childStr)
+            except:
+                attributes.append((childStr, None))
+            else:
+                if prop.include_hiddenTypes or type(cvalue) not in HiddenTypes:
+                    attributes.append((childStr, cvalue))
+        return attributes
+
+    def items(self, prop):
+        """Return (kind, count) of the items shown after the attributes.
+
+        kind is 'keys' for mappings, 'index' for sequences or None.
+        """
+        _val_dir = prop._get_dir()
+        if '__getitem__' in _val_dir:
+            if 'keys' in _val_dir:
+                try:
+                    return 'keys', len(prop.value)
+                except:
+                    try:
+                        return 'keys', len(self.keys(prop.value))
+                    except:
+                        # The users sequence object returned by keys is
+                        # raising exceptions, so let's just give up
+                        return 'keys', 0
+            # value doesn't seem to be a mappying-like thing, let's see
+            # if it is a sequence-like thing
+            elif '__len__' in _val_dir:
+                try:
+                    return 'index', len(prop.value)
+                except:
+                    return 'index', 0
+        return None, 0
+
+    def keys(self, value):
+        """Return the keys of a 'keys' value, in the order shown."""
+        return list(value.keys())
+
+    def dataSize(self, value):
+        if '__len__' not in dir(value):
+            return 0
+        return len(value)
+
+    def valueString(self, value, maxdata):
+        """Return repr(value), or only its first maxdata characters."""
+        if not maxdata:
+            return repr(value)
+        return boundedRepr(maxdata).repr(value)
+
+class _builtinSerializer(propertySerializer):
+    # builtin types have no attributes but their methods, which are
+    # hidden, so there is no need to look at them unless those are shown
+    itemKind = None
+
+    def attributes(self, prop):
+        if prop.include_private or prop.include_hiddenTypes:
+            return propertySerializer.attributes(self, prop)
+        return []
+
+    def items(self, prop):
+        if self.itemKind is None:
+            return None, 0
+        return self.itemKind, len(prop.value)
+
+    def dataSize(self, value):
+        return len(value)
+
+class _sequenceSerializer(_builtinSerializer):
+    itemKind = 'index'
+
+class _mappingSerializer(_builtinSerializer):
+    itemKind = 'keys'
+
+class _numberSerializer(_builtinSerializer):
+    def dataSize(self, value):
+        return 0
+
+_defaultSerializer = propertySerializer()
+
+# type -> serializer for values of exactly that type, subclasses may
+# have attributes of their own so they get the default
+_serializers = {}
+
+def register_serializer(typ, serializer):
+    """Make Property use serializer, a propertySerializer, for values of
+    type typ.  None goes back to the default.
+
+    Use it from a preload script (pydbgp -p) for your own container
+    types.
+    """
+    if serializer is None:
+        if typ in _serializers:
+            del _serializers[typ]
+    else:
+        _serializers[typ] = serializer
+
+register_serializer(types.ListType, _sequenceSerializer())
+register_serializer(types.TupleType, _sequenceSerializer())
+register_serializer(types.DictType, _mappingSerializer())
+for _typ in BaseTypes:
+    if _typ in StringTypes:
+        register_serializer(_typ, _builtinSerializer())
+    else:
+        register_serializer(_typ, _numberSerializer())
+try:
+    register_serializer(set, _builtinSerializer())
+    register_serializer(frozenset, _builtinSerializer())
+    register_serializer(bytearray, _sequenceSerializer())
+except NameError:
+    # older python
+    pass
+
+# what can't go into CDATA as it is: anything but printable ascii, tab
+# and newline (the xml parser turns \r into \n), and the end of the CDATA
+_cdataUnsafe = re.compile(r'[^\t\n\x20-\x7e]|\]\]>')
+
+def _autoEncode(data):
+    # the 'auto' data_encoding, base64 only for data that needs it
+    if type(data) in StringTypes and not _cdataUnsafe.search(data):
+        return data, 'none'
+    return base64.b64encode(data), 'base64'
+
 class Property:
     """DBGP Python Property class.
 
@@ -1120,8 +1981,15 @@ class Property:
         self.name = name
         self.fullname = fullname
         self.value = value
-        self._children = None
+        # index -> child property, see get_children
+        self._children = {}
         self._numchildren = None
+        self._dir = None
+        self._attributes = None
+        self._serializer = None
+        self._itemKind = None
+        self._itemCount = None
+        self._keys = None
         self.encoding = encoding
         self.include_private = include_private # to show __X__ names also
         # if examining a module, then let us see the children.  This should actually
@@ -1140,6 +2008,8 @@ class Property:
             pass
         if self.encoding == 'base64':
             return base64.encodestring(data), self.encoding
+        if self.encoding == 'auto':
+            return _autoEncode(data)
         return escape(data), None
         
     def get_encodedName(self):
@@ -1148,11 +2018,13 @@ class Property:
     def get_encodedFullname(self):
         return self._get_encodedData(self.fullname)
 
-    def get_encodedValue(self, maxdata = 0):
+    def get_encodedValue(self, maxdata = 0, offset = 0):
         # maxdata constraint, so we cannot use _get_encodedData
         data = self.value
         if maxdata:
-            data = self.value[:maxdata]
+            data = self.value[offset:offset+maxdata]
+        elif offset:
+            data = self.value[offset:]
         return self._get_encodedData(data)
 
     def get_type(self):
@@ -1170,15 +2042,13 @@ class Property:
         
     def get_dataSize(self):
         try:
-            if '__len__' not in dir(self.value):
-                return 0
-            return len(self.value)
+            return self._get_serializer().dataSize(self.value)
         except:
             return 0
     
-    def get_valueString(self):
+    def get_valueString(self, maxdata = 0):
         try:
-            return repr(self.value)
+            return self._get_serializer().valueString(self.value, maxdata)
         except:
             # XXX raise a CommandError exception?
             return "Looking at object failed - %s: %s" % (sys.exc_info()[0], sys.exc_info()[1])
@@ -1190,113 +2060,118 @@ class Property:
         # checking for properties should catch the vast majority of cases!
         if self.get_type() not in BaseTypes:
             # count the children and set into numchildren
-            self.get_children(1)
+            if type(self.value) in HiddenTypes and \
+               type(self.value) not in self.include_hiddenTypes and \
+               not self.include_private:
+                return 0
+            self._numchildren = len(self._get_attributes()) + \
+                                self._get_itemCount()
         return self._numchildren
 
-    def get_children(self, countOnly=0):
-        if self._children is not None:
-            return self._children
-
-        if type(self.value) in HiddenTypes and \
-           type(self.value) not in self.include_hiddenTypes and \
-           not self.include_private:
-            return []
-        
-        self._numchildren = 0
-        children = []
-        _val_dir = dir(self.value)
-        for childStr in _val_dir:
-            if ((not self.include_private) and \
-               (childStr[:1] == '_')) or \
-               childStr == "__builtins__":
-                continue
-            
-            try:
-                child = getattr(self.value, childStr)
-            except:
-                self._numchildren += 1
-                if countOnly: continue
-                c = Property(childStr,
-                             "%s.%s" % (self.name,childStr),
-                             None, self.encoding,
-                             self.include_private,
-                             self.include_hiddenTypes)
-                children.append(c)
-            else:
-                cvalue = _safe_apply("Getting attribute failed",
-                                    getattr, self.value, childStr)
-                if self.include_hiddenTypes or type(cvalue) not in HiddenTypes:
-                    self._numchildren += 1
-                    if countOnly: continue
-                    c = Property(childStr,
-                                 "%s.%s" % (self.name,childStr),
-                                 cvalue, self.encoding,
-                                 self.include_private,
-                                 self.include_hiddenTypes)
-                    children.append(c)
-        
+    def _get_dir(self):
+        if self._dir is None:
+            self._dir = dir(self.value)
+        return self._dir
+
+    def _get_serializer(self):
+        if self._serializer is None:
+            self._serializer = _serializers.get(type(self.value),
+                                                _defaultSerializer)
+        return self._serializer
+
+    def _get_attributes(self):
+        # (name, value) of the attributes we show as children, value is
+        # None if getting it failed
+        if self._attributes is None:
+            self._attributes = self._get_serializer().attributes(self)
+        return self._attributes
+
+    def _get_itemCount(self):
         # handle tuples, dicts and lists
-        # we always show a value for these types, even if it is in the hidden types list
-        if '__getitem__' in _val_dir:
-            #log.debug("value has __getitem__")
-            if 'keys' in _val_dir:
-                #log.debug("value has keys")
-                try:
-                     # repr introduces quotes if the object is already a string
-                     # (but the object may be one being debugged, and its repr
-                     # may fail!  This wouldn't be good, as it looks like the
-                     # debugger failed!
-                     # XXX Shouldn't return all of really big mappings but how
-                     # do we know what part the user is interested in?
-                    child_keys = self.value.keys()
-                    self._numchildren += len(child_keys)
-                    if not countOnly:
-                        for child in child_keys:
-                            cvalue = _safe_index("child", self.value, child)
-                            if type(child) not in types.StringTypes:
-                                cname = _safe_apply("repr", repr, child)
-                            else:
-                                cname = "'%s'" % child.replace("'","\'")
-                            c = Property(cname,
-                                         "%s[%s]" % (self.name,cname),
-                                         cvalue, self.encoding,
-                                         self.include_private,
-                                         self.include_hiddenTypes)
-                            children.append(c)
-                except:
-                    # The users sequence object returned by keys is raising
-                    # exceptions, so let's just give up 
-                    pass
-
-            # value doesn't seem to be a mappying-like thing, let's see
-            # if it is a sequence-like thing
-            elif '__len__' in _val_dir:
-                #log.debug("value has __len__")
-                try:
-                    vlen = len(self.value)
-                    self._numchildren += vlen
-                    if not countOnly:
-                        for child in range(vlen):
-                            cvalue = _safe_index("object", self.value, child)
-                            c = Property("[%d]" % child,
-                                         "%s[%d]" % (self.name,child),
-                                         cvalue, self.encoding,
-                                         self.include_private,
-                                         self.include_hiddenTypes)
-                            children.append(c)
-                except:
-                    pass
-        
-        if countOnly: return None
-        
-        self._children = children
+        # we always show a value for these types, even if it is in the
+        # hidden types list.  Only the number of items is worked out here,
+        # get_children makes properties for the ones it is asked for.
+        if self._itemCount is None:
+            self._itemKind, self._itemCount = \
+                self._get_serializer().items(self)
+        return self._itemCount
+
+    def _get_keys(self):
+        if self._keys is None:
+            self._keys = self._get_serializer().keys(self.value)
+        return self._keys
+
+    def _get_item(self, index):
+        if self._itemKind == 'keys':
+            # repr introduces quotes if the object is already a string
+            # (but the object may be one being debugged, and its repr
+            # may fail!  This wouldn't be good, as it looks like the
+            # debugger failed!
+            child = self._get_keys()[index]
+            cvalue = _safe_index("child", self.value, child)
+            if type(child) not in types.StringTypes:
+                cname = _safe_apply("repr", repr, child)
+            else:
+                cname = "'%s'" % child.replace("'","\'")
+            return Property(cname,
+                            "%s[%s]" % (self.name,cname),
+                            cvalue, self.encoding,
+                            self.include_private,
+                            self.include_hiddenTypes)
+        cvalue = _safe_index("object", self.value, index)
+        return Property("[%d]" % index,
+                        "%s[%d]" % (self.name,index),
+                        cvalue, self.encoding,
+                        self.include_private,
+                        self.include_hiddenTypes)
+
+    def get_children(self, start=0, end=None):
+        """Return the properties of children start up to end.
+
+        Only those are made, a page of a big list or dict doesn't cost
+        more than a small one.
+        """
+        numchildren = self.get_numchildren()
+        if end is None or end > numchildren:
+            end = numchildren
+        children = []
+        for index in range(start, end):
+            child = self._children.get(index)
+            if child is None:
+                attributes = self._get_attributes()
+                if index < len(attributes):
+                    childStr, cvalue = attributes[index]
+                    child = Property(childStr,
+                                     "%s.%s" % (self.name,childStr),
+                                     cvalue, self.encoding,
+                                     self.include_private,
+                                     self.include_hiddenTypes)
+                else:
+                    try:
+                        child = self._get_item(index - len(attributes))
+                    except:
+                        # the users object changed or is raising
+                        # exceptions, leave out what we can't get
+                        break
+                self._children[index] = child
+            children.append(child)
         return children
 
     def get_hasChildren(self):
         return int(self.get_numchildren() > 0)
     
     def toxml(self, depth = MAX_DEPTH, maxchildren = MAX_CHILDREN, maxdata = MAX_DATA, page = 0):
-        childprops = []
+        parts = []
+        self.writexml(parts, depth, maxchildren, maxdata, page)
+        return ''.join(parts)
+
+    def writexml(self, parts, depth = MAX_DEPTH, maxchildren = MAX_CHILDREN, maxdata = MAX_DATA, page = 0):
+        """Append the xml for the property to the list parts.
+
+        The xml of the children goes into the same list, so a big tree
+        isn't copied into a string at every level.
+        """
+        children = []
         numchildren = self.get_numchildren()
         haschildren = self.get_hasChildren()
         if depth > 0 and numchildren > 0:
@@ -1304,34 +2179,23 @@ class Property:
             end = start + maxchildren
             if end >= numchildren:
                 end = numchildren
-            #print "numchildren %s" % (numchildren)
-            #print "max children %s" % (maxchildren)
-            #print "page %s" % (page)
-            #print "getting %d children" % (end-start)
-            childprops = [child.toxml(depth-1, maxchildren, maxdata, 0)
-                          for child in self.get_children()[start:end]]
+            children = self.get_children(start, end)
 
         vType = type(self.value)
         if not self.include_private and \
            vType not in self.include_hiddenTypes and \
-           numchildren > 0 and not childprops and depth > 0:
+           numchildren > 0 and not children and depth > 0:
             numchildren = 0
             haschildren = 0
             
         value = ''
         if vType not in StringTypes:
             if numchildren == 0 or vType in HiddenTypes or vType == types.InstanceType:
-                value = '<value><![CDATA[%s]]></value>'  % (self.get_valueString()[:maxdata])
+                value = '<value><![CDATA[%s]]></value>'  % (self.get_valueString(maxdata)[:maxdata])
         else:
             data, encoding = self.get_encodedValue(maxdata)
             value = '<value encoding="%s"><![CDATA[%s]]></value>'  % (encoding, data)
 
-        name, encoding = self.get_encodedName()
-        childprops.append('<name encoding="%s"><![CDATA[%s]]></name>' % (encoding, name))
-        fullname, encoding = self.get_encodedFullname()
-        childprops.append('<fullname encoding="%s"><![CDATA[%s]]></fullname>' % (encoding, fullname))
-
-        value = value + ''.join(childprops)
         attrs = {'type': self.get_typeString(),
                  'children': haschildren,
                  'size': self.get_dataSize()}
@@ -1340,7 +2204,15 @@ class Property:
             attrs['pagesize'] = maxchildren
             attrs['numchildren'] = numchildren
 
-        return '<property %s>%s</property>' % (_getAttrStr(attrs), value)
+        parts.append('<property %s>' % _getAttrStr(attrs))
+        parts.append(value)
+        for child in children:
+            child.writexml(parts, depth-1, maxchildren, maxdata, 0)
+        name, encoding = self.get_encodedName()
+        parts.append('<name encoding="%s"><![CDATA[%s]]></name>' % (encoding, name))
+        fullname, encoding = self.get_encodedFullname()
+        parts.append('<fullname encoding="%s"><![CDATA[%s]]></fullname>' % (encoding, fullname))
+        parts.append('</property>')
 
 
 class dbgpClient(clientBase):
@@ -1353,7 +2225,8 @@ class dbgpClient(clientBase):
     fncache = {}
     
     def __init__(self, requester, ignoreList=[], module=None):
-        ignoreModules = ignoreList
+        if ignoreList:
+            set_ignore_modules(ignoreList)
 
         clientBase.__init__(self)
         self._interactiveDebugger = None
@@ -1368,11 +2241,17 @@ class dbgpClient(clientBase):
         self.stopframe = None
         self.returnframe = None
         self.quitting = 0
+        # stack depths used by stop_here, -1 when we don't know them
+        self.stackDepth = -1
+        self.frameDepth = -1
+        self.stopframeDepth = -1
+        self.botframeDepth = -1
 
     # Override the dbd set_* functions to manage our bottom frame fix.
     def set_step(self):
         self.botframeBehaviour = BOTFRAME_STEP
         self.stopframe = None
+        self.stopframeDepth = -1
         self.returnframe = None
         self.quitting = 0
 
@@ -1382,6 +2261,7 @@ class dbgpClient(clientBase):
         if frame is self.botframe:
             self.botframeBehaviour = BOTFRAME_STEP
         self.stopframe = frame
+        self.stopframeDepth = getFrameDepth(frame)
         self.returnframe = None
         self.quitting = 0
 
@@ -1394,6 +2274,7 @@ class dbgpClient(clientBase):
             # At the bot-frame and stepping out - like a "run"
             self.botframeBehaviour = BOTFRAME_CONTINUE
         self.stopframe = frame.f_back
+        self.stopframeDepth = getFrameDepth(frame) - 1
         self.returnframe = frame
         self.quitting = 0
 
@@ -1409,6 +2290,8 @@ class dbgpClient(clientBase):
                     frame.f_trace = self
                 self.botframe = frame
             frame = frame.f_back
+        if self.botframe is not None:
+            self.botframeDepth = getFrameDepth(self.botframe)
         self.set_step()
         self.starttrace()
 
@@ -1416,12 +2299,16 @@ class dbgpClient(clientBase):
         # Don't stop except at breakpoints or when finished
         self.botframeBehaviour = BOTFRAME_CONTINUE
         self.stopframe = None
+        self.stopframeDepth = -1
         self.returnframe = None
         self.quitting = 0
+        # only breakpoints can stop us now, stop counting the stack depth
+        self.stackDepth = -1
 
     def set_quit(self):
         self.botframeBehaviour = BOTFRAME_CONTINUE
         self.stopframe = self.botframe
+        self.stopframeDepth = self.botframeDepth
         self.returnframe = None
         self.quitting = 1
         self.stoptrace()
@@ -1653,9 +2540,31 @@ class dbgpSocket:
     port = 0
     orig_stdin = None
     notify_ok = 0
+    # responses are written in pieces of about this size
+    sendChunkSize = 65536
+    # and we ask for this much at a time from the IDE
+    recvSize = 65536
+    # send_response waits while this much is waiting to be written
+    maxOutgoing = 1 << 22
+    # how long flush waits for what is waiting to be written
+    stopTimeout = 5
+    # threads started by the program share this connection, see
+    # set_multiplexed
+    multiplexed = 0
     def __init__(self, mainThread, hostname = '', port = 9000, socket_type=socket.AF_INET):
         self.queue = TimedQueue()
         self.mainThread = mainThread
+        # thread key -> dbgpThreadChannel of the threads sharing this
+        # connection
+        self._threads = {}
+        # (size, parts) of the packets waiting for the writer thread,
+        # which is the only thread that writes to the socket
+        self._outgoing = collections.deque()
+        self._outgoingSize = 0
+        self._writing = 0
+        self._readerId = self._writerId = None
+        self._readerRunning = self._writerRunning = 0
+        self._writeReady = threading.Condition()
         # override stdin so we can send notifications
         if not dbgpSocket.orig_stdin:
             dbgpSocket.orig_stdin = sys.stdin
@@ -1675,14 +2584,113 @@ class dbgpSocket:
             sys.stderr.write("dbgpSocket: error: unable to connect to remote host at %s:%d\n\n"% (self.hostname,self.port))
             raise
         self._stop = 0
+        self._readerRunning = self._writerRunning = 1
         self._startCommandThread()
+        self._writerId = _nonDebugThread(self._writePackets, ())
         
     def stop(self):
+        # this runs in the reader thread for an async stop, so it must not
+        # wait for anything.  The writer closes the socket once it has sent
+        # what we have, like the response to stop or detach
         self._stop = 1
         self.queue.put(None)
-        if self._socket:
-            self._socket.close()
-            self._socket = None
+        self._writeReady.acquire()
+        try:
+            self._writeReady.notifyAll()
+            closeNow = not self._writerRunning
+        finally:
+            self._writeReady.release()
+        if closeNow:
+            self._closeSocket()
+        self._closeThreads()
+
+    def flush(self):
+        """Wait until the writer thread has sent the packets waiting to be
+        written, at most stopTimeout seconds.
+
+        Once stopped, also wait for the reader and writer threads to end,
+        so the program does not exit under them.  Only the thread running
+        the program calls this.
+        """
+        if thread.get_ident() in (self._readerId, self._writerId):
+            return
+        self._writeReady.acquire()
+        try:
+            end = time.time() + self.stopTimeout
+            while time.time() < end and \
+                  (self._outgoing or self._writing or
+                   (self._stop and
+                    (self._readerRunning or self._writerRunning))):
+                self._writeReady.wait(0.05)
+        finally:
+            self._writeReady.release()
+        if self._stop:
+            # the IDE did not read what we had, give up on it
+            self._closeSocket()
+
+    def _closeSocket(self):
+        sock = self._socket
+        self._socket = None
+        if sock is not None:
+            try:
+                # wakes up the reader blocked in recv
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error, e:
+                pass
+            sock.close()
+
+    def afterFork(self):
+        # in a forked child the connection is the parent's.  Let go of our
+        # copy of it without shutdown, which would end it for the parent
+        # too.  Our reader and writer threads did not come along.
+        self._stop = 1
+        self._readerRunning = self._writerRunning = 0
+        sock = self._socket
+        self._socket = None
+        if sock is not None:
+            try:
+                # a reader that did not survive the fork may still hold
+                # the socket object, close the descriptor itself now
+                getattr(sock, '_sock', sock).close()
+            except socket.error, e:
+                pass
+        self._threads = {}
+
+    def set_multiplexed(self, value):
+        """Have the threads the program starts share this connection.
+
+        Their packets carry a thread attribute, and commands for them
+        come with a -T <thread> option.  Returns 1 on success.
+        """
+        global _threadConnection
+        self.multiplexed = value
+        if value:
+            _threadConnection = self
+        elif _threadConnection is self:
+            _threadConnection = None
+        return 1
+
+    def addThread(self, client):
+        """Start a session for client's thread on this connection."""
+        channel = dbgpThreadChannel(self, client)
+        self._threads[channel.key] = channel
+        return channel
+
+    def removeThread(self, channel):
+        if self._threads.get(channel.key) is channel:
+            del self._threads[channel.key]
+
+    def _closeThreads(self):
+        # without the connection the threads can't be stopped by the IDE,
+        # let them run as if it had detached
+        global _threadConnection
+        if _threadConnection is self:
+            _threadConnection = None
+        for channel in self._threads.values():
+            channel._stop = 1
+            channel.mainThread._detach = 1
+            channel.queue.put(None)
+        self._threads = {}
 
     def _getIncomingDataPacket(self):
         # _getIncomingDataPacket needs to be in a thread that
@@ -1690,66 +2698,214 @@ class dbgpSocket:
         # _getIncomingDataPacket should also dispatch
         # calls for stdin so we can debug raw_input
         log.debug("_getIncomingDataPacket starting...")
-        # gets the next chunk of data until a null byte is
-        # encountered
-        data = ''
+        # commands end with a null byte.  Everything before scanned in
+        # buffer has been looked at already, a big command coming in many
+        # pieces is only searched once
+        buffer = bytearray()
+        scanned = 0
         while not self._stop:
             log.debug("_getIncomingDataPacket getting data...")
             try:
-                data = data + self._socket.recv(1024)
-            except socket.error, e:
+                data = self._socket.recv(self.recvSize)
+            except (socket.error, AttributeError), e:
                 # socket was closed on us, quit now
                 log.debug("_getIncomingDataPacket socket closed")
                 self.queue.put(None)
+                self._closeThreads()
                 break
             if not data:
                 # protocol error, we should never receive an empty
                 # data set
                 log.debug("_getIncomingDataPacket socket closed")
                 self.queue.put(None)
+                self._closeThreads()
                 break
-            log.debug("    %d[%s]" , len(data), data)
+            log.debug("    received %d bytes", len(data))
+            buffer.extend(data)
 
-            while data:
-                eop = data.find('\0')
+            start = 0
+            while 1:
+                eop = buffer.find('\0', scanned)
                 if eop < 0:
+                    scanned = len(buffer)
                     break
-                
-                cmddata = data[:eop]
-                data = data[eop+1:] # skip \0
-                
-                argv = listcmd.line2argv(cmddata)
-    
-                log.debug("    put data in queue [%r]", cmddata)
-                # stdin blocks the executing thread, so we have to do the async
-                # stdin call here.  This only happens with remote debugging when
-                # stdin is redirected.
-                if argv[0] in ['stdin', 'stop']:
-                    self.mainThread.onecmd(argv, 'do_async_')
-                else:
-                    self.mainThread.dbg.interrupt = 1
-                    self.queue.put(argv)
+                cmddata = str(buffer[start:eop])
+                start = scanned = eop + 1 # skip \0
+                self._handleCommand(cmddata)
+            if start:
+                del buffer[:start]
+                scanned = scanned - start
 
         log.debug("_getIncomingDataPacket exiting...")
 
+    def _splitCommand(self, cmddata):
+        # line2argv looks at one character at a time, which is slow for
+        # the base64 data after -- of a big stdin or property_set.  Data
+        # without quotes or escapes only needs splitting on whitespace
+        eop = cmddata.find(' -- ')
+        if eop >= 0:
+            for ch in '"\'\\':
+                if ch in cmddata:
+                    break
+            else:
+                return listcmd.line2argv(cmddata[:eop]) + ['--'] + \
+                       cmddata[eop+4:].split()
+        return listcmd.line2argv(cmddata)
+
+    def _threadOption(self, argv):
+        # take the -T <thread> option out of argv, DBGP options always
+        # come in pairs up to the --
+        i = 1
+        while i < len(argv) - 1 and argv[i] != '--':
+            if argv[i] == '-T':
+                key = argv[i+1]
+                del argv[i:i+2]
+                return key
+            i = i + 2
+        return None
+
+    def _handleCommand(self, cmddata):
+        argv = self._splitCommand(cmddata)
+        if not argv:
+            return
+
+        channel = self
+        if self.multiplexed:
+            key = self._threadOption(argv)
+            if key is not None:
+                channel = self._threads.get(key)
+                if channel is None:
+                    tid = self.mainThread._getTransactionId(argv[1:])
+                    err = CommandError(argv[0], tid,
+                                       ERROR_COMMAND_NOT_AVAILABLE,
+                                       'thread %s is not being debugged' % key)
+                    self.send_response(str(err), key)
+                    return
+
+        log.debug("    put data in queue [%r]", cmddata)
+        # stdin blocks the executing thread, so we have to do the async
+        # stdin call here.  This only happens with remote debugging when
+        # stdin is redirected.
+        if argv[0] in ['stdin', 'stop']:
+            channel.mainThread.onecmd(argv, 'do_async_')
+        else:
+            channel.mainThread.dbg.interrupt = 1
+            channel.queue.put(argv)
+
     def _startCommandThread(self):
-        _nonDebugThread(self._getIncomingDataPacket, ())
+        self._readerId = _nonDebugThread(self._readPackets, ())
 
-    def send_response(self, response):
+    def _readPackets(self):
+        # the reader thread, flush waits for it to end after stop
+        try:
+            self._getIncomingDataPacket()
+        finally:
+            self._writeReady.acquire()
+            self._readerRunning = 0
+            self._writeReady.notifyAll()
+            self._writeReady.release()
+
+    def send_response(self, response, thread=None):
+        """Send a response to the IDE.
+
+        response is the xml as a string, or a list of the strings that
+        make it up, which are written as they are without joining them.
+        thread is the key of the thread the packet is from on a
+        multiplexed connection.
+        """
         if self._stop:
             return
-        header = u'<?xml version="1.0" encoding="utf-8"?>\n'
-        response = (header+response)
-        try:
-            response = response.encode('utf-8')
-        except (UnicodeEncodeError,UnicodeDecodeError), e:
-            pass
-        l = len(response)
-        #log.debug('sending [%r]', response)
+        if type(response) in StringTypes:
+            response = [response]
+        if thread is not None and not response[0].startswith('<init '):
+            # init already has the thread attribute, it ends with the key
+            response = list(response)
+            end = _elementName.match(response[0]).end()
+            response[0] = '%s thread="%s"%s' % (response[0][:end], thread,
+                                                response[0][end:])
+        # parts[0] is the length, once we know it
+        parts = [None, '<?xml version="1.0" encoding="utf-8"?>\n']
+        l = len(parts[1])
+        for part in response:
+            if type(part) == types.UnicodeType:
+                part = part.encode('utf-8')
+            parts.append(part)
+            l = l + len(part)
+        parts[0] = '%d\0' % l
+        parts.append('\0')
+        #log.debug('sending [%r]', parts)
+        self._writeReady.acquire()
         try:
-            self._socket.send('%d\0%s\0' % (l, response))
-        except socket.error, e:
-            self.stop()
+            # don't let a program that writes faster than the IDE reads
+            # fill up memory
+            while self._outgoingSize > self.maxOutgoing and not self._stop:
+                self._writeReady.wait(0.05)
+            self._outgoing.append((len(parts[0]) + l + 1, parts))
+            self._outgoingSize = self._outgoingSize + len(parts[0]) + l + 1
+            self._writeReady.notifyAll()
+        finally:
+            self._writeReady.release()
+
+    def _writePackets(self):
+        # the writer thread.  Packets that are ready together go out in
+        # the same writes, see _sendParts
+        while 1:
+            self._writeReady.acquire()
+            try:
+                while not self._outgoing and not self._stop:
+                    self._writeReady.wait()
+                if not self._outgoing:
+                    break
+                parts = []
+                size = 0
+                while self._outgoing and size < self.sendChunkSize:
+                    packetSize, packet = self._outgoing.popleft()
+                    parts.extend(packet)
+                    size = size + packetSize
+                self._writing = 1
+            finally:
+                self._writeReady.release()
+            failed = 0
+            try:
+                self._sendParts(parts)
+            except (socket.error, AttributeError), e:
+                # the IDE went away, or stop closed the socket
+                failed = 1
+                self._stop = 1
+                self.queue.put(None)
+            self._writeReady.acquire()
+            self._outgoingSize = self._outgoingSize - size
+            self._writing = 0
+            if failed:
+                # nobody is going to read the rest
+                self._outgoing.clear()
+                self._outgoingSize = 0
+            self._writeReady.notifyAll()
+            self._writeReady.release()
+        # stopped, and everything is sent
+        self._closeSocket()
+        self._writeReady.acquire()
+        self._writerRunning = 0
+        self._writeReady.notifyAll()
+        self._writeReady.release()
+
+    def _sendParts(self, parts):
+        # small parts are joined up to sendChunkSize, big ones are sent
+        # as they are
+        chunk = []
+        size = 0
+        for part in parts:
+            if chunk and size + len(part) > self.sendChunkSize:
+                self._socket.sendall(''.join(chunk))
+                chunk = []
+                size = 0
+            if len(part) >= self.sendChunkSize:
+                self._socket.sendall(part)
+            else:
+                chunk.append(part)
+                size = size + len(part)
+        if chunk:
+            self._socket.sendall(''.join(chunk))
 
     def notify(self, name, data=None):
         if not self.notify_ok: return
@@ -1759,6 +2915,46 @@ class dbgpSocket:
         else:
             out += '/>'
         self.send_response(out)
+
+# the element name at the start of a packet
+_elementName = re.compile(r'<[\w:]+')
+
+# the connection new threads share, see dbgpSocket.set_multiplexed
+_threadConnection = None
+
+class dbgpThreadChannel(dbgpSocket):
+    """The session of one thread on a multiplexed dbgpSocket.
+
+    It has the queue and send_response of a dbgpSocket, the connection
+    routes the thread's commands to it and tags what it sends.
+    """
+    multiplexed = 1
+    def __init__(self, connection, mainThread):
+        self.queue = TimedQueue()
+        self.mainThread = mainThread
+        self.connection = connection
+        self.key = str(mainThread.thread_id)
+        self._stop = connection._stop
+
+    def connect(self):
+        pass
+
+    def stop(self):
+        self._stop = 1
+        self.queue.put(None)
+        self.connection.removeThread(self)
+
+    def flush(self):
+        self.connection.flush()
+
+    def set_multiplexed(self, value):
+        # only the session that owns the connection decides
+        return 0
+
+    def send_response(self, response):
+        if self._stop:
+            return
+        self.connection.send_response(response, self.key)
         
 
 class backend(listcmd.ListCmd):
@@ -1776,6 +2972,10 @@ class backend(listcmd.ListCmd):
     # application wide configuration
     _encoding = 'utf-8'
     _data_encoding = 'base64'
+    # the feature_set values a thread's session takes from the session of
+    # the connection it shares, see attach
+    _sessionSettings = ['_encoding', '_data_encoding', '_max_children',
+                        '_max_data', '_max_depth', '_show_hidden']
     
     def __init__(self, idekey = 0, preloadScript = None, ignoreModules = [], module=None):
         listcmd.ListCmd.__init__(self)
@@ -1785,6 +2985,7 @@ class backend(listcmd.ListCmd):
         self._stdin = None
         self._stdout = None
         self._stderr = None
+        self._streamSender = None
         self._continue = RESUME_STOP
         self._continueTransactionId = None
         self._continuationCommand = None
@@ -1792,6 +2993,10 @@ class backend(listcmd.ListCmd):
         self._break_status = STATUS_STOPPED
         self._lastErrorMessage = ''
         self._detach = 0
+        # no session until connect or attach, see attachOnStop
+        self.socket = None
+        self._attachOnStop = 0
+        self.threadName = 'unknown'
         self.thread_id = thread.get_ident()
         if not backend.appid:
             if hasattr(os, 'getpid'):
@@ -1810,6 +3015,10 @@ class backend(listcmd.ListCmd):
         # interactive debugger support
         self._interactiveBuffer = []
         self._isInteractiveShell = 0
+
+        # (depth, context_id, fullname) -> Property, the variables the
+        # IDE looked at in this stop, see backendCmd._cachedProperty
+        self._propertyCache = {}
         
         registerClient(self)
         self.dbg = dbgpClient(self, ignoreModules, module=module)
@@ -1819,20 +3028,83 @@ class backend(listcmd.ListCmd):
     
     def connect(self, hostname = '', port = 9000, name = 'unknown',
                 args = ['interactive'], socket_type=socket.AF_INET):
+        _installForkHooks()
+        self.threadName = name
         self.socket = dbgpSocket(self, hostname, port, socket_type)
         self.socket.connect()
         self.sendInit(name, args[0])
 
+    def attach(self, connection, name = 'unknown', args = ['interactive']):
+        # start a session for this thread on connection, a multiplexed
+        # dbgpSocket.  The IDE set up the session of the connection, the
+        # thread's session starts with its settings
+        self.socket = connection.addThread(self)
+        for attr in self._sessionSettings:
+            if hasattr(connection.mainThread, attr):
+                setattr(self, attr, getattr(connection.mainThread, attr))
+        self.sendInit(name, args[0])
+
+    def attachOnStop(self):
+        # a thread started with lazy thread support is traced without a
+        # session, it connects now that it has to stop.  Returns 0 if it
+        # can't.
+        filename = 'interactive'
+        if self.dbg.stack:
+            filename = self.dbg.stack[0][0].f_code.co_filename
+        self._attachOnStop = 1
+        self._break_status = STATUS_BREAK
+        connection = _threadConnection
+        try:
+            if connection is not None and not connection._stop:
+                self.attach(connection, self.threadName, [filename])
+            else:
+                self.connect('', 9000, self.threadName, [filename])
+        except socket.error, e:
+            log.error("thread %s could not connect to the IDE", self.threadName)
+            self.socket = None
+            self._detach = 1
+            return 0
+        return 1
+
+    def afterFork(self):
+        # in a forked child, the session was the parent's.  Either run on
+        # and connect as a new application when we stop, or stop
+        # debugging altogether, see forkMode
+        if self.socket is not None:
+            self.socket.afterFork()
+        self.socket = None
+        self._streamSender = None
+        self._stdin = self._stdout = self._stderr = None
+        self._continue = RESUME_STOP
+        self._continueTransactionId = None
+        self._continuationCommand = None
+        self._propertyCache = {}
+        self._attachOnStop = 0
+        self._stop = self._detach = 0
+        if forkMode == 'reattach':
+            self.dbg.set_continue()
+        else:
+            self._detach = 1
+            self.dbg.set_quit()
+
     def notify(self, name, data=None):
         self.socket.notify(name, data)
 
     def stopNow(self):
         self._stop = self._detach = 1
-        self.socket.stop()
+        self._stopStreams()
+        if self.socket is not None:
+            self.socket.stop()
     
     def detachNow(self):
         self._detach = 1
-        self.socket.stop()
+        self._stopStreams()
+        if self.socket is not None:
+            self.socket.stop()
+
+    def _stopStreams(self):
+        if self._streamSender is not None:
+            self._streamSender.stop()
         
     def close(self):
         self.stopNow()
@@ -1842,7 +3114,7 @@ class backend(listcmd.ListCmd):
         self._break_status = STATUS_STOPPING
         self.send_continuationResult(self._continue, STATUS_STOPPING, REASON_OK)
 
-        if not self._stop:
+        if not self._stop and self.socket is not None:
             # we want to stop now until the IDE chooses to end the session
             while not self._detach:
                 self.cmdloop()
@@ -1918,11 +3190,13 @@ class backend(listcmd.ListCmd):
             _print_exc()
             self.send_continuationResult(self._continue, STATUS_STOPPING, REASON_EXCEPTION)
 
-        if not self._stop:
+        if not self._stop and self.socket is not None:
             # we want to stop now until the IDE chooses to end the session
             while not self._detach:
                 self.cmdloop()
 
+        if self.socket is not None:
+            self.socket.flush()
         self.dbg = None
         deregisterClient(self)
         
@@ -1947,6 +3221,10 @@ class backend(listcmd.ListCmd):
         except SystemExit, e:  # if someone does a sys.exit(), it's not really an exception.
             if not (self._stop or self._detach):
                 self.send_continuationResult(self._continue, end_status, REASON_ABORTED)
+            if self.socket is not None:
+                # the process ends now, the writer thread has to send
+                # that first
+                self.socket.flush()
             raise
         except:
             # uncaught exception, enter interactive mode
@@ -1970,13 +3248,15 @@ class backend(listcmd.ListCmd):
             
         deregisterClient(self)
         warnMainThreadEnding()
-        if not self._stop:
+        if not self._stop and self.socket is not None:
             # we want to stop now until the IDE chooses to end the session
             while not self._detach:
                 self.cmdloop()
 
         if self._stdin:
             sys.stdin = self._stdin.stop()
+        if self.socket is not None:
+            self.socket.flush()
         self.dbg = None
 
     def getHostName(self):
@@ -2003,6 +3283,10 @@ class backend(listcmd.ListCmd):
         else:
             filename = pathname2url(filename)
             attrs['fileuri'] = filename
+        if self._attachOnStop:
+            # the IDE should not run the thread, it has stopped already
+            attrs['status'] = status_names[STATUS_BREAK]
+            attrs['reason'] = reason_names[REASON_OK]
         
         self.socket.send_response('<init %s/>' % _getAttrStr(attrs))
 
@@ -2015,6 +3299,10 @@ class backend(listcmd.ListCmd):
         # loop reading commands until no more commands are avialable
         # if this is async, only do one command
         #log.debug("cmdloop async=%d", async)
+        if self.socket is None:
+            if async or self._detach or not self.attachOnStop():
+                # keep running without the IDE
+                return RESUME_GO
         if async and not self.poll():
             return self._continue
         self._continue = RESUME_STOP
@@ -2047,16 +3335,31 @@ class backend(listcmd.ListCmd):
 
         return self._continue
     
+    def write_stream(self, cmd, data):
+        # output from StreamOut, sent by StreamSender
+        if not data:
+            return
+        if self._streamSender is None:
+            self._streamSender = StreamSender(self)
+        self._streamSender.write(cmd, data)
+
+    def flush_streams(self):
+        if self._streamSender is not None:
+            self._streamSender.flush()
+
     def send_stream(self, cmd, data=None):
         if not data:
             return
         _template = '<stream type="%s" encoding="%s">%s</stream>'
-        if self._data_encoding == 'base64':
-            data = base64.encodestring(data).rstrip()
-        else:
+        encoding = self._data_encoding
+        if encoding == 'none':
             data = escape(data)
+        else:
+            # 'auto' is only for properties
+            encoding = 'base64'
+            data = base64.encodestring(data).rstrip()
 
-        self.socket.send_response(_template % (cmd,self._data_encoding,data))
+        self.socket.send_response(_template % (cmd,encoding,data))
 
     def send_continuationResult(self, command, status, reason):
         if self._continueTransactionId is None:
@@ -2064,6 +3367,8 @@ class backend(listcmd.ListCmd):
             return
         
         _template = '<response xmlns="urn:debugger_protocol_v1" command="%s" status="%s" reason="%s" transaction_id="%s"%s/>'
+        # the IDE sees the output of the program before it stops
+        self.flush_streams()
         self._break_reason = reason
         self._break_status = status
         name = resume_command_names[command]
@@ -2217,7 +3522,9 @@ class backendCmd(backend):
         return self._data_encoding
 
     def set_feature_data_encoding(self, value):
-        if value == 'base64' or value == 'none':
+        # 'auto' sends property names and values that are plain ascii as
+        # they are, and the rest in base64
+        if value in ['base64', 'none', 'auto']:
             self._data_encoding = value
             return 1
         return 0
@@ -2236,6 +3543,29 @@ class backendCmd(backend):
         set_thread_support(self.debug_threads)
         return 1
 
+    def get_feature_fork_mode(self):
+        return forkMode
+
+    def set_feature_fork_mode(self, value):
+        try:
+            set_fork_mode(value)
+        except DBGPError, e:
+            return 0
+        return 1
+
+    def get_feature_lazy_threads(self):
+        return lazyThreads
+
+    def set_feature_lazy_threads(self, value):
+        set_lazy_threads(long(value))
+        return 1
+
+    def get_feature_multiplex_threads(self):
+        return self.socket.multiplexed
+
+    def set_feature_multiplex_threads(self, value):
+        return self.socket.set_multiplexed(long(value))
+
     def get_feature_max_children(self):
         return self._max_children
 
@@ -2268,6 +3598,26 @@ class backendCmd(backend):
         dbgpSocket.notify_ok = long(value)
         return 1
 
+    def get_feature_exception_break_mode(self):
+        return exceptionBreakMode
+
+    def set_feature_exception_break_mode(self, value):
+        try:
+            set_exception_break_mode(value)
+        except DBGPError, e:
+            return 0
+        return 1
+
+    def get_feature_stream_overflow(self):
+        return streamOverflow
+
+    def set_feature_stream_overflow(self, value):
+        try:
+            set_stream_overflow(value)
+        except DBGPError, e:
+            return 0
+        return 1
+
     def get_feature_supports_postmotem(self):
         return 1
 
@@ -2322,6 +3672,12 @@ class backendCmd(backend):
         self.dbg.set_step()
         self.dbg.starttrace()
 
+        # threads without a session yet break too, at the next call they
+        # make, and connect then
+        for client in _clientInstances.values():
+            if client is not self and client.socket is None and client.dbg:
+                client.dbg.set_step()
+
         # we dont know if this will successfully break or not :(
         _template = '<response xmlns="urn:debugger_protocol_v1" command="break" transaction_id="%s" success="1"/>'
         self.socket.send_response(_template % (tid))
@@ -2355,6 +3711,7 @@ class backendCmd(backend):
         self._break_status = STATUS_RUNNING
         self._continueTransactionId = tid
         self._continuationCommand = self._continue = state
+        self._propertyCache.clear()
         
     def do_run(self, cmdargs, *args):
         self._do_continue('run', cmdargs, RESUME_GO, *args)
@@ -2474,6 +3831,8 @@ class backendCmd(backend):
             self._getopts(cmdargs, self._context_get_optlist, "context_get")
         
         contextTypes = hiddenContextTypes[context_id]
+        _template = '<response xmlns="urn:debugger_protocol_v1" command="context_get" context="%d" transaction_id="%s">'
+        parts = [_template % (context_id, tid)]
         try:
             frame, lineno = self.dbg.stack[depth]
             if context_id == 0: # Locals
@@ -2484,7 +3843,6 @@ class backendCmd(backend):
                 raise CommandError('context_get', tid, ERROR_CONTEXT_INVALID,
                                    'Invalid context id [%d] requested' % context_id)
 
-            ret = []
             names = items.keys()
             def mycmp(i,j): return cmp(i.lower(), j.lower())
             names.sort(mycmp)
@@ -2502,18 +3860,20 @@ class backendCmd(backend):
                         continue
                 elif typ in HiddenTypes and name not in frame.f_code.co_varnames:
                         continue
-                itemProperty = Property(name, name, item, self._data_encoding,
-                                        self._show_hidden, contextTypes)
+                itemProperty = self._cachedProperty(depth, context_id, name)
+                if itemProperty is None or itemProperty.value is not item:
+                    itemProperty = Property(name, name, item, self._data_encoding,
+                                            self._show_hidden, contextTypes)
+                    self._cacheProperty(depth, context_id, itemProperty)
     
-                ret.append( itemProperty.toxml(0,  self._max_children, self._max_data) )
+                itemProperty.writexml(parts, 0, self._max_children, self._max_data)
         except Exception, e:
             tb = escape(''.join(traceback.format_list(traceback.extract_tb(sys.exc_info()[2]))))
             raise CommandError('context_get', tid, ERROR_EXCEPTION,
                                'Unknown exception %s\n%s' % (str(e),tb))
         
-        _template = '<response xmlns="urn:debugger_protocol_v1" command="context_get" context="%d" transaction_id="%s">%s</response>'
-        data = ''.join(ret)
-        self.socket.send_response(_template % (context_id, tid, data))
+        parts.append('</response>')
+        self.socket.send_response(parts)
 
     def _getObject(self, frame_index, expr):
         frame, lineno = self.dbg.stack[frame_index]
@@ -2543,6 +3903,31 @@ class backendCmd(backend):
 
         return value, typ
 
+    def _cachedProperty(self, depth, context_id, fullname):
+        # the property the IDE already looked at in this stop, so we
+        # don't eval fullname again or work out its children again
+        prop = self._propertyCache.get((depth, context_id, fullname))
+        if prop is not None and prop.encoding == self._data_encoding and \
+           prop.include_private == self._show_hidden:
+            return prop
+        return None
+
+    def _cacheProperty(self, depth, context_id, prop):
+        self._propertyCache[(depth, context_id, prop.fullname)] = prop
+
+    def _cacheChildren(self, depth, context_id, prop):
+        # the IDE asks for the children we sent when it expands them,
+        # keep their values so that doesn't start again from the top
+        for child in prop._children.values():
+            key = (depth, context_id, child.fullname)
+            if not self._propertyCache.has_key(key):
+                self._propertyCache[key] = Property(child.fullname,
+                                                    child.fullname,
+                                                    child.value,
+                                                    child.encoding,
+                                                    child.include_private,
+                                                    child.include_hiddenTypes)
+
 
     _property_get_optlist = [['i', 'transaction_id', int, 1, -1, None],
                ['d', 'depth', int, 0, 0, _validateStackDepth],
@@ -2556,58 +3941,74 @@ class backendCmd(backend):
          maxdata, datatype, datapage, data,) = \
             self._getopts(cmdargs, self._property_get_optlist, "property_get")
 
-        value, typ = self._getContextObject(context_id, depth, fullname)
-        if typ == 'Error':
-            value, typ = self._getObject(depth, fullname)
+        prop = self._cachedProperty(depth, context_id, fullname)
+        if prop is None:
+            value, typ = self._getContextObject(context_id, depth, fullname)
             if typ == 'Error':
-                raise CommandError('property_get', tid,
-                                   ERROR_PROPERTY_DOES_NOT_EXIST, value)
+                value, typ = self._getObject(depth, fullname)
+                if typ == 'Error':
+                    raise CommandError('property_get', tid,
+                                       ERROR_PROPERTY_DOES_NOT_EXIST, value)
+            prop = Property(fullname, fullname, value, self._data_encoding,
+                                self._show_hidden, hiddenContextTypes[context_id])
+            self._cacheProperty(depth, context_id, prop)
         if not maxdata:
             maxdata = self._max_data
-        
-        prop = Property(fullname, fullname, value, self._data_encoding,
-                            self._show_hidden, hiddenContextTypes[context_id])
-
-        _template = '<response xmlns="urn:debugger_protocol_v1" command="property_get" context="%d" transaction_id="%s">%s</response>'
 
-        self.socket.send_response(_template %
-                           (context_id, tid,
-                            prop.toxml(self._max_depth,
-                                       self._max_children,
-                                       maxdata,
-                                       datapage)))
+        _template = '<response xmlns="urn:debugger_protocol_v1" command="property_get" context="%d" transaction_id="%s">'
+        parts = [_template % (context_id, tid)]
+        prop.writexml(parts, self._max_depth, self._max_children, maxdata,
+                      datapage)
+        parts.append('</response>')
+        self.socket.send_response(parts)
+        self._cacheChildren(depth, context_id, prop)
 
 
     _property_value_optlist = [['i', 'transaction_id', int, 1, -1, None],
                ['d', 'depth', int, 0, 0, _validateStackDepth],
                ['c', 'context_id', int, 0, 0, _validateContextId],
-               ['n', 'fullname', str, 1, None, None]]
+               ['n', 'fullname', str, 1, None, None],
+               ['m', 'maxdata', int, 0, 0, None],
+               ['o', 'offset', int, 0, 0, None]]
     def do_property_value(self, cmdargs, *args):
-        (tid, depth, context_id, fullname, data,) = \
+        # -o and -m get maxdata of the value from offset on, so the IDE
+        # can look through a big string without getting all of it
+        (tid, depth, context_id, fullname, maxdata, offset, data,) = \
             self._getopts(cmdargs, self._property_value_optlist, "property_value")
+        if offset < 0 or maxdata < 0:
+            raise CommandError('property_value', tid, ERROR_INVALID_ARGS,
+                               'invalid offset or maxdata')
 
-        value, typ = self._getContextObject(context_id, depth, fullname)
-        if typ == 'Error':
-            raise CommandError('property_value', tid,
-                               ERROR_PROPERTY_DOES_NOT_EXIST, value)
-
-        prop = Property(fullname, fullname, value, self._data_encoding,
-                            self._show_hidden, hiddenContextTypes[context_id])
+        prop = self._cachedProperty(depth, context_id, fullname)
+        if prop is None:
+            value, typ = self._getContextObject(context_id, depth, fullname)
+            if typ == 'Error':
+                raise CommandError('property_value', tid,
+                                   ERROR_PROPERTY_DOES_NOT_EXIST, value)
+            prop = Property(fullname, fullname, value, self._data_encoding,
+                                self._show_hidden, hiddenContextTypes[context_id])
+            self._cacheProperty(depth, context_id, prop)
         
-        _template = '<response xmlns="urn:debugger_protocol_v1" command="property_value" size="%d" encoding="%s" transaction_id="%s">%s</response>'
+        _template = '<response xmlns="urn:debugger_protocol_v1" command="property_value" size="%d" encoding="%s"%s transaction_id="%s">'
         vType = prop.get_type()
         encoding=''
-        value=''
         size=0
         if vType not in StringTypes:
             #if prop.numchildren == 0 or vType in HiddenTypes or vType == types.InstanceType:
-            value = '<![CDATA[%s]]>'  % prop.get_valueString()
+            if maxdata:
+                data = prop.get_valueString(offset+maxdata)[offset:offset+maxdata]
+            else:
+                data = prop.get_valueString()[offset:]
         else:
-            value = '<![CDATA[%s]]>'  % prop.get_encodedValue()[0]
-            encoding = prop.encoding
-        if value:
-            size = prop.get_dataSize()
-        self.socket.send_response(_template % (size, encoding, tid, value))
+            data, encoding = prop.get_encodedValue(maxdata, offset)
+            encoding = encoding or prop.encoding
+        # there is always a value, even if it is empty
+        size = prop.get_dataSize()
+        window = ''
+        if offset:
+            window = ' offset="%d"' % offset
+        self.socket.send_response([_template % (size, encoding, window, tid),
+                                   '<![CDATA[', data, ']]></response>'])
 
 
     _property_set_optlist = [['i', 'transaction_id', int, 1, -1, None],
@@ -2620,8 +4021,10 @@ class backendCmd(backend):
         (tid, depth, context_id, fullname, data_type, data_length, data,) = \
             self._getopts(cmdargs, self._property_set_optlist, "property_set")
         frame, lineno = self.dbg.stack[depth]
+        # setting one variable can change what others show
+        self._propertyCache.clear()
 
-        if self._data_encoding == 'base64':
+        if self._data_encoding != 'none':
             try:
                 data = base64.decodestring(data)
             except:
@@ -2924,13 +4327,15 @@ class backendCmd(backend):
         (tid, data_length, context_id, data,) = self._getopts(cmdargs, self._eval_optlist, "eval")
         
         # read data_length from the socket
-        if self._data_encoding == 'base64':
+        if self._data_encoding != 'none':
             try:
                 data = base64.decodestring(data)
             except:
                 pass
         data = data + "\n"
         frame, lineno = self.dbg.stack[0]
+        # the expression can change what variables show
+        self._propertyCache.clear()
         try:
             value = eval(data, frame.f_globals, frame.f_locals)
         except Exception, e:
@@ -2940,16 +4345,12 @@ class backendCmd(backend):
         prop = Property(None, None, value, self._data_encoding,
                             self._show_hidden) # , hiddenContextTypes[context_id])
         
-        _template = '<response xmlns="urn:debugger_protocol_v1" command="eval" transaction_id="%s">%s</response>'
-
-        # self.socket.send_response(_template % (tid, value))
-
-        self.socket.send_response(_template %
-                           (tid,
-                            prop.toxml(self._max_depth,
-                                       self._max_children,
-                                       self._max_data,
-                                       0)))
+        _template = '<response xmlns="urn:debugger_protocol_v1" command="eval" transaction_id="%s">'
+        parts = [_template % tid]
+        prop.writexml(parts, self._max_depth, self._max_children,
+                      self._max_data, 0)
+        parts.append('</response>')
+        self.socket.send_response(parts)
 
     _source_optlist = [['i', 'transaction_id', int, 1, -1, None],
                ['f','filename', str, 0, None, None],
@@ -2994,18 +4395,21 @@ class backendCmd(backend):
         else:
             source = ''.join(source)
         
-        if self._data_encoding == 'base64':
-            source = base64.encodestring(source)
-        else:
+        encoding = self._data_encoding
+        if encoding == 'none':
             source = escape(source)
+        else:
+            encoding = 'base64'
+            source = base64.encodestring(source)
 
         
         _template = '<response xmlns="urn:debugger_protocol_v1" command="source" transaction_id="%s" ' +\
                     'filename="%s" startline="%d" endline="%d" ' +\
-                    'encoding="%s"><![CDATA[%s]]></response>'
-        self.socket.send_response(_template % (tid, fullpath, startline,
-                                        endline, self._data_encoding,
-                                        source))
+                    'encoding="%s"><![CDATA['
+        # the source is sent as it is, not copied into the response
+        self.socket.send_response([_template % (tid, fullpath, startline,
+                                                endline, encoding),
+                                   source, ']]></response>'])
     
     def do_async_stdin(self, cmdargs, *args):
         self.do_stdin(cmdargs, args)
@@ -3137,6 +4541,7 @@ class backendCmd(backend):
         
         lastStatus = self._break_status
         self._break_status = STATUS_INTERACTIVE
+        self._propertyCache.clear()
         
         prompt = ">>> "
         more = 0
@@ -3308,9 +4713,19 @@ def _dbgp_start_new_thread(function, args=(), kwargs={}):
         name = repr(function)
 
     client = backendCmd()
-    ## the values for host and port do not matter here, they are retrieved
-    ## appropriately from the class variables
-    client.connect('', 9000, name)
+    connection = _threadConnection
+    if lazyThreads:
+        # trace the thread with the breakpoints we have, it connects when
+        # it first stops, see backend.attachOnStop
+        client.threadName = name
+        client.dbg.set_continue()
+    elif connection is not None and not connection._stop:
+        # the IDE asked for threads to share the connection
+        client.attach(connection, name)
+    else:
+        ## the values for host and port do not matter here, they are retrieved
+        ## appropriately from the class variables
+        client.connect('', 9000, name)
     client.runThread(function, args, kwargs)
 
 def _thread_start_new_thread(function, args=(), kwargs={}):
@@ -3321,6 +4736,18 @@ def _thread_start_new_thread(function, args=(), kwargs={}):
     # the new thread.
     return thread._thread_start_new_thread(_dbgp_start_new_thread, (function, args), kwargs)
 
+# new threads connect to the IDE when they first stop rather than when
+# they start, see set_lazy_threads
+lazyThreads = 0
+
+def set_lazy_threads(lazy):
+    """Have threads started from now on connect when they first stop.
+
+    Most threads of a pool never stop, so they never need a session.
+    """
+    global lazyThreads
+    lazyThreads = lazy
+
 def set_thread_support(debug_threads):
     import thread, threading
     if debug_threads:
@@ -3334,25 +4761,101 @@ def set_thread_support(debug_threads):
             threading._start_new_thread = thread.start_new_thread
             del thread._thread_start_new_thread
 
+# what a child of os.fork does about the parent's session:
+#   'reattach'  it runs on, and connects to the IDE as a new application
+#               (with the parent's appid as its parent) when it stops
+#   'dormant'   it stops debugging
+forkMode = 'reattach'
+
+def set_fork_mode(mode):
+    """Select what a forked child does, see forkMode.
+
+    Raises DBGPError for an unknown mode.
+    """
+    global forkMode
+    if mode not in ['reattach', 'dormant']:
+        raise DBGPError('unknown fork mode %r' % mode)
+    forkMode = mode
+
+def _afterForkInChild():
+    # we are the only thread of the new process.  The connections are the
+    # parent's, and the threads that served them are gone
+    global _threadConnection
+    client = _clientInstances.get(thread.get_ident())
+    for other in _clientInstances.values():
+        if other.socket is not None:
+            other.socket.afterFork()
+    _clientInstances.clear()
+    _threadConnection = None
+
+    # the streams we redirected went to the parent's session
+    for name in ['stdout', 'stderr']:
+        stream = getattr(sys, name)
+        while isinstance(stream, StreamOut):
+            stream = stream._origStream
+        setattr(sys, name, stream)
+    while isinstance(sys.stdin, (StreamStdin, StreamIn)):
+        sys.stdin = sys.stdin._origStream
+    dbgpSocket.orig_stdin = None
+
+    # we are a new application
+    backend.parent_appid = str(backend.appid)
+    backend.appid = os.getpid()
+    if hasattr(os, 'putenv'):
+        os.putenv('DEBUGGER_APPID', str(backend.appid))
+
+    if forkMode != 'reattach':
+        set_thread_support(0)
+    if client is not None and client.dbg is not None:
+        client.afterFork()
+        if forkMode == 'reattach':
+            registerClient(client)
+
+def _dbgp_fork():
+    pid = os._dbgp_fork()
+    if pid == 0:
+        _afterForkInChild()
+    return pid
+
+def _dbgp_forkpty():
+    pid, fd = os._dbgp_forkpty()
+    if pid == 0:
+        _afterForkInChild()
+    return pid, fd
+
+_forkHooks = 0
+def _installForkHooks():
+    # called when we first connect.  Pythons without
+    # os.register_at_fork get os.fork and os.forkpty replaced
+    global _forkHooks
+    if _forkHooks:
+        return
+    _forkHooks = 1
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=_afterForkInChild)
+        return
+    if hasattr(os, 'fork'):
+        os._dbgp_fork = os.fork
+        os.fork = _dbgp_fork
+    if hasattr(os, 'forkpty'):
+        os._dbgp_forkpty = os.forkpty
+        os.forkpty = _dbgp_forkpty
+
 def stopDBGP(client):
     log.debug("stopDBGP: atexit has been called")
     # prevent stepping into functions we call
-    global DBGPHideChildren
-    origDBGPHideChildren = DBGPHideChildren
-    DBGPHideChildren = DBGPDebugDebugger is not 2
+    origDBGPHideChildren = _hideChildren(DBGPDebugDebugger is not 2)
     try:
         client.atexit()
     finally:
-        DBGPHideChildren = origDBGPHideChildren
+        _hideChildren(origDBGPHideChildren)
 
 _connectionData = None
 def brk(host = '127.0.0.1', port = 9000, idekey = '',
         preloadScript = None, logLevel = logging.WARN):
     global _connectionData
     # prevent stepping into functions we call
-    global DBGPHideChildren
-    origDBGPHideChildren = DBGPHideChildren
-    DBGPHideChildren = DBGPDebugDebugger is not 2
+    origDBGPHideChildren = _hideChildren(DBGPDebugDebugger is not 2)
     try:
         client = getClientForThread()
         if client:
@@ -3394,7 +4897,7 @@ def brk(host = '127.0.0.1', port = 9000, idekey = '',
         atexit.register(stopDBGP, client)
         client.breakNow()
     finally:
-        DBGPHideChildren = origDBGPHideChildren
+        _hideChildren(origDBGPHideChildren)
 
 _orig_excepthook = None
 def excepthook(type, value, tb):
@@ -3404,9 +4907,7 @@ def excepthook(type, value, tb):
     
     sys.excepthook = _orig_excepthook
     
-    global DBGPHideChildren
-    origDBGPHideChildren = DBGPHideChildren
-    DBGPHideChildren = DBGPDebugDebugger is not 2
+    origDBGPHideChildren = _hideChildren(DBGPDebugDebugger is not 2)
     try:
         # we print the traceback to the regular stdout, since we don't know if or
         # when the IDE will redirect stdin so it can receive the traceback
@@ -3435,7 +4936,7 @@ def excepthook(type, value, tb):
         client.connect(_connectionData['host'], _connectionData['port'], name, scriptArgs)
         client.runExceptHook(type, value, tb)
     finally:
-        DBGPHideChildren = origDBGPHideChildren
+        _hideChildren(origDBGPHideChildren)
     sys.exit(1)
 
 def brkOnExcept(host = '127.0.0.1', port = 9000, idekey = '',
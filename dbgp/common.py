@@ -124,6 +124,14 @@ def getenv(key, default=None):
         return default
     return retval
 
+def getFrameDepth(frame):
+    # the number of frames on the stack, counting this one
+    depth = 0
+    while frame is not None:
+        depth = depth + 1
+        frame = frame.f_back
+    return depth
+
 class DBGPError(Exception):
     pass
 
@@ -468,6 +468,11 @@ class stackFrame:
 
 
 class property:
+    # getValue fetches what it doesn't have in windows of max_data, but at
+    # least this many characters, so a big value doesn't take thousands
+    # of round trips
+    minValueWindow = 1 << 20
+
     def __init__(self):
         self.name = ''
         self.id = ''
@@ -503,6 +508,10 @@ class property:
         try:
             if value and (self.encoding == 'base64' or encoding == 'base64'):
                 value = base64.decodestring(value)
+            elif value and encoding == 'none':
+                # plain ascii sent as it is, see session.initFeatures,
+                # give it the same type a decoded value has
+                value = str(value)
         except:
             pass
         return value
@@ -656,9 +665,35 @@ class property:
 
     def getValue(self):
         if self.size > len(self.value):
-            self.value = self.session.propertyValueEx(self.contextId, self.depth, self.fullname)
+            # we have the first max_data characters, get the rest a window
+            # at a time so neither side builds all of it into one packet
+            window = max(self.session.maxData, self.minValueWindow)
+            parts = [self.value]
+            offset = len(self.value)
+            while offset < self.size and self.session.supportsValueRange:
+                part = self.getValueRange(offset, window)
+                if not part:
+                    break
+                parts.append(part)
+                offset = offset + len(part)
+            if self.session.supportsValueRange:
+                self.value = ''.join(parts)
+            else:
+                # the client sends all of the value or nothing
+                self.value = self.session.propertyValueEx(self.contextId, self.depth, self.fullname)
         return self.value
 
+    def getValueRange(self, offset, length):
+        """Return length characters of the value from offset on.
+
+        Only that part of the value is fetched if we don't have it
+        already, so a huge string can be looked at a piece at a time.
+        """
+        if offset + length <= len(self.value) or self.size <= len(self.value):
+            return self.value[offset:offset+length]
+        return self.session.propertyValueEx(self.contextId, self.depth,
+                                            self.fullname, offset, length)
+
 
 class session(dbgp.serverBase.session):
     def __init__(self, sessionHost):
@@ -687,10 +722,27 @@ class session(dbgp.serverBase.session):
         self.languageName = ''
         self.languageVersion = ''
         self.maxChildren = 0
+        # cleared when the client rejects property_value -o/-m
+        self.supportsValueRange = 1
         
         self.interactivePrompt = ''
         self.interactiveState = 0
 
+        # the threads of the program share our connection, see
+        # _dispatchThread
+        self.multiplexed = 0
+        self._threadSessions = {}
+        # for the session of a thread on another session's connection,
+        # that session and the key of the thread
+        self._connection = None
+        self._threadKey = None
+
+    def _cmdloop(self):
+        try:
+            dbgp.serverBase.session._cmdloop(self)
+        finally:
+            self._stopThreadSessions()
+
     def _dispatch(self, size,response):
         # THREAD WARNING
         # this function is called from the command loop thread.  Do
@@ -701,6 +753,50 @@ class session(dbgp.serverBase.session):
         #log.debug(response)
         dom = minidom.parseString(response)
         root = dom.documentElement
+        if self.multiplexed and root.hasAttribute('thread'):
+            self._dispatchThread(root)
+        else:
+            self._dispatchNode(root)
+
+    def _dispatchThread(self, root):
+        # a packet from one of the threads on our connection.  The thread
+        # attribute of its init ends with the key the other packets have
+        key = root.getAttribute('thread').split()[-1]
+        if root.localName == 'init':
+            ses = self.__class__(self._sessionHost)
+            ses._startThreadSession(self, key)
+            self._threadSessions[key] = ses
+        else:
+            ses = self._threadSessions.get(key)
+            if ses is None:
+                log.debug('packet from unknown thread %s', key)
+                return
+        ses._dispatchNode(root)
+
+    def _startThreadSession(self, connection, key):
+        self._connection = connection
+        self._threadKey = key
+        self._socket = connection._socket
+        self._sendLock = connection._sendLock
+        self._clientAddr = connection._clientAddr
+
+    def _stopThreadSessions(self):
+        # our connection is gone, and with it the threads that shared it
+        sessions = self._threadSessions.values()
+        self._threadSessions = {}
+        for ses in sessions:
+            ses._socket = None
+            ses._stop = 1
+            if ses._application and ses._application.haveSession(ses):
+                ses._application.releaseSession(ses)
+
+    def sendCommand(self, argv, data = None):
+        if self._threadKey is not None:
+            # the client routes the command to our thread by -T
+            argv = [argv[0], '-T', self._threadKey] + argv[1:]
+        return dbgp.serverBase.session.sendCommand(self, argv, data)
+
+    def _dispatchNode(self, root):
         packetType = root.localName
         if packetType == 'stream':
             type = root.getAttribute('type').lower()
@@ -719,11 +815,18 @@ class session(dbgp.serverBase.session):
                     self._application.shutdown()
                 else:
                     self._application.releaseSession(self)
-                try:
-                    self._socket.close()
-                finally:
+                if self._connection is not None:
+                    # the connection stays open for the other threads
+                    if self._connection._threadSessions.get(self._threadKey) is self:
+                        del self._connection._threadSessions[self._threadKey]
                     self._socket = None
                     self._stop = 1
+                else:
+                    try:
+                        self._socket.close()
+                    finally:
+                        self._socket = None
+                        self._stop = 1
                     
             if command in ['run', 'step_into', 'step_over',
                            'step_out', 'stop', 'detach', 'interact']:
@@ -794,6 +897,52 @@ class session(dbgp.serverBase.session):
             # we've closed the session
             return
 
+        if self._connection is not None:
+            # a thread on a multiplexed connection, the client started it
+            # with the settings of the connection's session
+            self._copyFeatures(self._connection)
+        elif not self._negotiateFeatures():
+            return
+
+        # grab the breakpoint list now
+        try:
+            # some languages, eg. Tcl, have to do some processing before
+            # breakpoints are set.  This notification allows hooks to be
+            # added for that purpose
+            if self._application and self._application.sessionCount() == 1:
+                self._sessionHost.notifyStartup(self, initNode)
+            
+            err = self._sessionHost.breakpointManager.setSessionBreakpoints(self)
+            #XXX Should, ideally, show this error to the user somehow. Ideas:
+            #    - pop up a dialog and offer to cancel debugging?
+            #    - status bar message?
+            #    - display the breakpoint/spawnpoint markers slightly
+            #      differently and remember this data so that the properties
+            #      page for the breakpoint shows that this is not set on
+            #      the session
+            if err:
+                log.error("the following breakpoints/spawnpoints could not "
+                          "be set on this session:\n%s" % err)
+        except Exception, e:
+            log.error('breakpoints failed to be set properly')
+            pass
+        if not self._stop:
+            if initNode.hasAttribute('status'):
+                # it connected when it first stopped, a thread (see the
+                # lazy_threads feature) or a forked child.  The IDE
+                # decides when it goes on.
+                self.stateChange(initNode)
+            # are we a new thread in the app?  If so, then just do
+            # the run command now
+            if self._application and self._application.sessionCount() > 1:
+                if not initNode.hasAttribute('status'):
+                    self.resume(RESUME_GO)
+                # no notifyInit for threads in an app
+                return
+            
+            self._sessionHost.notifyInit(self, initNode)
+
+    def _negotiateFeatures(self):
         # gather some necessary information for this session
         # any information we need during an async operation needs
         # to be retreived prior to async commands being done
@@ -804,96 +953,116 @@ class session(dbgp.serverBase.session):
             self.supportsAsync = int(self.featureGet('supports_async'))
         except Exception, e:
             log.debug('init thread supportsAsync unknown')
-            if self._stop: return
+            if self._stop: return 0
         try:
             self.languageName = self.featureGet('language_name')
         except Exception, e:
             log.debug('init thread languageName unknown')
-            if self._stop: return
+            if self._stop: return 0
         try:
             self.languageVersion = self.featureGet('language_version')
         except Exception, e:
             log.debug('init thread languageVersion unknown')
-            if self._stop: return
+            if self._stop: return 0
         try:
             self.maxChildren = int(self.featureGet('max_children'))
         except Exception, e:
             self.maxChildren = 0
             log.debug('init thread maxChildren unknown')
-            if self._stop: return
+            if self._stop: return 0
         try:
             self.maxData = int(self.featureGet('max_data'))
         except Exception, e:
             self.maxData = 0
             log.debug('init thread maxData unknown')
-            if self._stop: return
+            if self._stop: return 0
         try:
             self.maxDepth = int(self.featureGet('max_depth'))
         except Exception, e:
             self.maxDepth = 0
             log.debug('init thread maxDepth unknown')
-            if self._stop: return
+            if self._stop: return 0
         try:
             self.featureGet('show_hidden')
             self.supportsHiddenVars = 1
         except Exception, e:
             self.supportsHiddenVars = 0
             log.debug('init supportsHiddenVars false')
-            if self._stop: return
+            if self._stop: return 0
         try:
             self.featureGet('supports_postmortem')
             self.supportsPostmortem = 1
         except Exception, e:
             self.supportsPostmortem = 0
             log.debug('init supportsPostmortem false')
-            if self._stop: return
+            if self._stop: return 0
+        try:
+            # have names and values sent without base64 when they don't
+            # need it, clients that don't know 'auto' keep base64
+            self.featureSet('data_encoding', 'auto')
+        except Exception, e:
+            log.debug('init thread data_encoding auto unknown')
+            if self._stop: return 0
+        try:
+            # have the program's threads share this connection
+            self.featureSet('multiplex_threads', '1')
+            self.multiplexed = 1
+        except Exception, e:
+            log.debug('init thread multiplex_threads unknown')
+            if self._stop: return 0
+        try:
+            # threads connect when they first stop, most never do
+            self.featureSet('lazy_threads', '1')
+        except Exception, e:
+            log.debug('init thread lazy_threads unknown')
+            if self._stop: return 0
         try:
             self.featureSet('multiple_sessions', '1')
         except Exception, e:
             log.debug('init thread multiple_sessions unknown')
-            if self._stop: return
+            if self._stop: return 0
         try:
             # let the engine know it can send us notifications
             self.featureSet('notify_ok', '1')
         except Exception, e:
             log.debug('engine does not support notifications')
-            if self._stop: return
+            if self._stop: return 0
         try:
             self._supportsOptionalCommand('break')
         except Exception, e:
             log.debug('init thread break unknown')
-            if self._stop: return
+            if self._stop: return 0
         try:
             self._supportsOptionalCommand('eval')
         except Exception, e:
             log.debug('init thread eval unknown')
-            if self._stop: return
+            if self._stop: return 0
         try:
             self._supportsOptionalCommand('stdin')
         except Exception, e:
             log.debug('init thread stdin unknown')
-            if self._stop: return
+            if self._stop: return 0
         try:
             self._supportsOptionalCommand('detach')
         except Exception, e:
             log.debug('init thread detach unknown')
-            if self._stop: return
+            if self._stop: return 0
         try:
             self._supportsOptionalCommand('interact')
         except Exception, e:
             log.debug('does not support interactive debugger')
-            if self._stop: return
+            if self._stop: return 0
         try:
             self.breakpointLanguages = [l.lower() for l in self.featureGet('breakpoint_languages').split(',')]
         except Exception, e:
-            if self._stop: return
+            if self._stop: return 0
             self.breakpointLanguages = [self.languageName]
         log.debug('init thread breakpoint_languages %r', self.breakpointLanguages)
         try:
             self._getTypeMap()
         except Exception, e:
             log.error('unable to retrieve typeMap from client')
-            if self._stop: return
+            if self._stop: return 0
         # pass the url mapping to the engine
         try:
             if self._supportsOptionalCommand('urimap'):
@@ -902,39 +1071,22 @@ class session(dbgp.serverBase.session):
                     self.featureSet('urimap', map)
         except Exception, e:
             log.debug('client does not support urimap feature')
-            if self._stop: return
+            if self._stop: return 0
                 
-        # grab the breakpoint list now
-        try:
-            # some languages, eg. Tcl, have to do some processing before
-            # breakpoints are set.  This notification allows hooks to be
-            # added for that purpose
-            if self._application and self._application.sessionCount() == 1:
-                self._sessionHost.notifyStartup(self, initNode)
-            
-            err = self._sessionHost.breakpointManager.setSessionBreakpoints(self)
-            #XXX Should, ideally, show this error to the user somehow. Ideas:
-            #    - pop up a dialog and offer to cancel debugging?
-            #    - status bar message?
-            #    - display the breakpoint/spawnpoint markers slightly
-            #      differently and remember this data so that the properties
-            #      page for the breakpoint shows that this is not set on
-            #      the session
-            if err:
-                log.error("the following breakpoints/spawnpoints could not "
-                          "be set on this session:\n%s" % err)
-        except Exception, e:
-            log.error('breakpoints failed to be set properly')
-            pass
-        if not self._stop:
-            # are we a new thread in the app?  If so, then just do
-            # the run command now
-            if self._application and self._application.sessionCount() > 1:
-                self.resume(RESUME_GO)
-                # no notifyInit for threads in an app
-                return
-            
-            self._sessionHost.notifyInit(self, initNode)
+        return 1
+
+    def _copyFeatures(self, ses):
+        self.supportsAsync = ses.supportsAsync
+        self.languageName = ses.languageName
+        self.languageVersion = ses.languageVersion
+        self.maxChildren = ses.maxChildren
+        self.maxData = ses.maxData
+        self.maxDepth = ses.maxDepth
+        self.supportsHiddenVars = ses.supportsHiddenVars
+        self.supportsPostmortem = ses.supportsPostmortem
+        self.breakpointLanguages = ses.breakpointLanguages
+        self._supportedCommands = ses._supportedCommands.copy()
+        self._typeMap = ses._typeMap
 
     def notify(self, name, text, node):
         # "node" is the reponse node from the last continuation command
@@ -1295,11 +1447,23 @@ class session(dbgp.serverBase.session):
     def propertyValue(self, name):
         return self.propertyValueEx(0, 0, name)
 
-    def propertyValueEx(self, contextId, stackDepth, name):
+    def propertyValueEx(self, contextId, stackDepth, name, offset=0, length=0):
         self._noAsync('property_value')
         args = ['property_value', '-c', str(contextId), '-d',
                 str(stackDepth), '-n', name]
-        node = self.sendCommandWait(args)
+        if offset or length:
+            args += ['-o', str(offset), '-m', str(length)]
+        try:
+            node = self.sendCommandWait(args)
+        except DBGPError, e:
+            if not (offset or length) or e.args[1:] != (ERROR_INVALID_ARGS,):
+                raise
+            # a client that doesn't know -o and -m, get all of it
+            self.supportsValueRange = 0
+            value = self.propertyValueEx(contextId, stackDepth, name)
+            if length:
+                return value[offset:offset+length]
+            return value[offset:]
 
         encoding = None
         if node.hasAttribute('encoding'):
@@ -1314,6 +1478,8 @@ class session(dbgp.serverBase.session):
         try:
             if value and encoding == 'base64':
                 value = base64.decodestring(value)
+            elif value and encoding == 'none':
+                value = str(value)
         except:
             pass
 
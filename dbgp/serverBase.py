@@ -53,6 +53,8 @@ class session:
         self._stop = 0
         self._transaction_id = 0
         self._sessionHost = sessionHost
+        # sessions sharing the socket write commands one at a time
+        self._sendLock = threading.Lock()
 
     def _cmdloop(self):
         # called periodicaly by the debugger while the script is
@@ -180,7 +182,11 @@ class session:
         try:
             #print "sendCommand: %s"% cmdline
             log.debug("sendCommand: %s", cmdline)
-            self._socket.sendall(cmdline+'\0')
+            self._sendLock.acquire()
+            try:
+                self._socket.sendall(cmdline+'\0')
+            finally:
+                self._sendLock.release()
             #log.debug("sendCommand: %s DONE", cmdline)
         except socket.error, e:
             log.error("session sendCommand socket error %r", e)